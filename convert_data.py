@@ -8,44 +8,73 @@ name is given on the command line) and executes "pdftohtml -xml" on each of the
 shot by shot summary PDF files, to produce more easily readable XML files and
 .png images corresponding to the stone placement.
 
-Usage: python convert_data.py (event_name)
+The conversions are independent of each other, so they are run in parallel
+with a process pool (one worker per CPU core by default).
+
+Usage: python convert_data.py (event_name) [--jobs N]
 event_name: An optional short name, if only want to convert one event's worth of
 data.
+--jobs N: The number of conversions to run at once (defaults to the number of
+CPU cores).
 """
-import glob
+import argparse
 import os
-import sys
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
-#Get the working directory for this project.
-#Since we're switching between paths, need to be relative to this.
-working_dir = os.getcwd()
 
-#Now, we want to get the paths to the folders that the shot by shot summaries
-#are stored in.
-glob_string = "data/"
+def convert(job):
+    """
+    Worker function for the process pool.  Takes a (directory, file name) pair
+    and runs "pdftohtml -xml" on that file with the directory as the working
+    directory, so the XML and PNG outputs land next to the PDF.
 
-if len(sys.argv) > 1:
-    glob_string += sys.argv[1] + "/*/*/"
-else:
-    glob_string += "/*/*/*/"
+    The command is run directly rather than through a shell, and with
+    close_fds=False so that subprocess can use the faster posix_spawn() path.
+    """
+    file_dir, summary = job
+    print("pdftohtml -xml " + os.path.join(file_dir, summary), flush = True)
+    subprocess.run(["pdftohtml", "-xml", summary], cwd = file_dir,
+            close_fds = False, check = False, stdin = subprocess.DEVNULL)
 
-dir_list = glob.glob(glob_string)
 
-#Now that we have a list of the directories with shot by shot summaries, change
-#to each of them in turn, get a list of all the .pdf files in them, and execute
-#pdftohtml -xml on them.
+def main(event = None, jobs = None):
+    """
+    Converts all the shot by shot summaries in the data directory (or just
+    those for one event, if its short name is given), running up to jobs
+    conversions at once.
+    """
+    #Find all the shot by shot summary PDFs below the data directory (or the
+    #event's directory) in one walk of the tree.  Matching on the summary file
+    #names means we don't pick up the .xml and .png files pdftohtml produced
+    #on a previous run.
+    data_dir = Path("data")
+    if event is not None:
+        data_dir = data_dir / event
 
-for file_dir in dir_list:
+    #Build a flat list of (directory, file) jobs.  Each job gets its own
+    #working directory in the worker, so we never need to change directory in
+    #this process.
+    job_list = [(str(summary.parent), summary.name)
+            for summary in sorted(data_dir.rglob("*_Shot_by_Shot_*.pdf"))]
 
-    os.chdir(file_dir)
+    #Hand the jobs out to the workers.  The chunksize amortizes the cost of
+    #sending jobs to the workers.
+    with ProcessPoolExecutor(max_workers = jobs) as executor:
+        list(executor.map(convert, job_list, chunksize = 8))
 
-    file_list = glob.glob("*")
 
-    for summary in file_list:
-        command = "pdftohtml -xml " + summary
-        print(command)
-        os.system(command)
+#Everything is run from main() under this guard, so that the process pool's
+#workers can import this script without re-running the conversion (which is
+#what happens when they are started with "spawn", e.g. on Windows and macOS).
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Convert the shot by shot "
+            "summary PDFs to XML and PNG files with pdftohtml.")
+    parser.add_argument("event", nargs = "?", default = None,
+            help = "The short name of a single event to convert.")
+    parser.add_argument("--jobs", type = int, default = os.cpu_count(),
+            help = "The number of conversions to run at once.")
+    args = parser.parse_args()
 
-    #Once we're done with this directory, go back to the original working
-    #directory.
-    os.chdir(working_dir)
+    main(args.event, args.jobs)
@@ -10,6 +10,18 @@ Creates the database file curling_data.db in the current directory.
 import database_functions as db
 
 
+#Before anything is written to the file, set the database-wide settings that
+#are stored in the file itself.
+#page_size: 8 KiB pages.  This can only be changed before the first table is
+#   created (and not at all once in WAL mode), so it has to happen here.
+#journal_mode: Write-ahead logging, so the database can be read while it is
+#   being written to.  This setting persists for every later connection.
+#The per-connection settings (cache size, memory mapping, etc.) are applied
+#each time database_functions opens its connection.
+db.run_command("PRAGMA page_size=8192")
+db.run_command("PRAGMA journal_mode=WAL")
+
+
 #Start by creating the events table that stores the information about the
 #events the curling games are a part of.
 #id: ID number of this event, the primary key.
@@ -145,3 +157,49 @@ CREATE TABLE IF NOT EXISTS stone_positions(
 );
 """
 db.run_command(c)
+
+
+#SQLite does not index foreign key columns automatically, so add indexes on
+#all of them.  Otherwise every join between the tables (and every lookup of
+#the ends of a game, shots of an end, etc.) has to scan the whole child table.
+c = """
+CREATE INDEX IF NOT EXISTS idx_games_event_id ON games(event_id);
+"""
+db.run_command(c)
+
+c = """
+CREATE INDEX IF NOT EXISTS idx_ends_game_id ON ends(game_id);
+"""
+db.run_command(c)
+
+c = """
+CREATE INDEX IF NOT EXISTS idx_shots_end_id ON shots(end_id);
+"""
+db.run_command(c)
+
+c = """
+CREATE INDEX IF NOT EXISTS idx_stone_positions_shot_id ON stone_positions(shot_id);
+"""
+db.run_command(c)
+
+
+#A compact alternative layout of the stone positions, with one row per shot
+#rather than one row per stone.  Filled from the stone_positions table by
+#database_functions.build_packed_stone_positions(), and read back with
+#database_functions.unpack_stone_positions().
+#shot_id: The ID number of the shot that these stone positions follow.
+#red_mask: Bit i is set if slot i in coords holds a red stone.
+#yellow_mask: Bit i is set if slot i in coords holds a yellow stone.
+#coords: 16 (x, y) pairs of little-endian float32 values (128 bytes), in the
+#   same coordinate system as stone_positions.  Slots with neither mask bit
+#   set are unused.
+c = """
+CREATE TABLE IF NOT EXISTS stone_positions_packed(
+    shot_id INTEGER PRIMARY KEY,
+    red_mask INTEGER,
+    yellow_mask INTEGER,
+    coords BLOB,
+        FOREIGN KEY (shot_id) REFERENCES shots(id)
+);
+"""
+db.run_command(c)
@@ -9,10 +9,72 @@ project).
 
 The database is located at the CADBPATH environment variable.
 
+All the functions here share one connection to the database, which is opened
+the first time it is needed and kept open (with its page cache) until the
+process exits.  The connection is in autocommit mode, so each command is its
+own transaction unless it is run inside a connection() block.
+
+run_query returns a pandas dataframe, for analysis.  For lookups of a single
+value or a few rows, run_scalar and run_rows return plain Python values
+instead, and pandas is only imported once something actually needs it.
+
 """
 import sqlite3
-import pandas as pd
+import numpy as np
 import os
+import atexit
+import functools
+import itertools
+from contextlib import contextmanager
+
+#The number of stone slots in a stone_positions_packed row (8 stones a team).
+N_STONE_SLOTS = 16
+
+#The most ? placeholders bulk_insert() will put in one statement.  This is the
+#limit in older versions of sqlite (newer ones allow more).
+MAX_VARIABLES = 999
+
+#The shared connection to the database.  Use _get_conn() rather than this.
+_conn = None
+
+
+def _get_conn():
+    """
+    Returns the shared connection to the curling_data database, opening it
+    and setting it up the first time this is called.
+    """
+    global _conn
+
+    if _conn is None:
+        _conn = sqlite3.connect(os.getenv("CADBPATH"))
+
+        #Autocommit mode.  Transactions are only opened explicitly, by
+        #connection().
+        _conn.isolation_level = None
+
+        #NB: The journal mode (WAL) and page size are stored in the database
+        #file itself, and are set when it is created by create_database.py.
+        #Setting the journal mode here would stop create_database.py from
+        #being able to pick the page size.
+        #In WAL mode, synchronous=NORMAL only syncs at checkpoints rather than
+        #at every commit.
+        _conn.execute("PRAGMA synchronous=NORMAL")
+
+        #128 MiB page cache (negative values are in KiB), read the database
+        #through a memory mapping of up to 256 MiB, and keep temporary tables
+        #and indices in memory.
+        _conn.execute("PRAGMA cache_size=-131072")
+        _conn.execute("PRAGMA mmap_size=268435456")
+        _conn.execute("PRAGMA temp_store=MEMORY")
+
+        #Foreign key constraints are only enforced on connections that ask for
+        #it.
+        _conn.execute("PRAGMA foreign_keys=ON")
+
+        atexit.register(_conn.close)
+
+    return _conn
+
 
 def run_query(q):
     """
@@ -20,26 +82,265 @@ def run_query(q):
     dataframe with the the result of running that query on the curling_data
     database.
     """
-    with sqlite3.connect(os.getenv("CADBPATH")) as conn:
-        return pd.read_sql(q, conn)
+    import pandas as pd
+
+    return pd.read_sql(q, _get_conn())
+
+
+def run_scalar(q, params = ()):
+    """
+    A function that takes an SQL query (optionally with ? placeholders and
+    their parameters) and returns the first column of the first row of the
+    result, or None if there are no rows.
+    """
+    row = _get_conn().execute(q, params).fetchone()
+    if row is None:
+        return None
+
+    return row[0]
+
+
+def run_rows(q, params = ()):
+    """
+    A function that takes an SQL query (optionally with ? placeholders and
+    their parameters) and returns all the rows of the result as a list of
+    tuples.
+    """
+    return _get_conn().execute(q, params).fetchall()
+
+
+def run_command(c, params = ()):
+    """
+    A function that takes an SQL command (optionally with ? placeholders and
+    their parameters) as an argument and executes it using the sqlite module on
+    the curling_data database.
+    """
+    _get_conn().execute(c, params)
+
+
+@contextmanager
+def connection():
+    """
+    A context manager that yields the connection to the curling_data database,
+    for callers that want to run many commands in a single transaction.  The
+    transaction is committed when the block exits normally, or rolled back if
+    an exception is raised.  Any run_command or run_many calls made inside the
+    block are part of the same transaction.
+
+    If a transaction is already open (i.e. this is nested inside another
+    connection() block), the block simply becomes part of the outer
+    transaction.
+    """
+    conn = _get_conn()
+
+    if conn.in_transaction:
+        yield conn
+        return
+
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+@contextmanager
+def bulk_load():
+    """
+    A context manager for the initial population of the database.  Like
+    connection(), everything inside the block runs in a single transaction,
+    but durability is switched off for the duration (synchronous=OFF) to avoid
+    syncing to disk during the load.  The journal mode is left as it is (WAL),
+    since switching out of WAL needs the database to ourselves, and turning
+    off synchronous is what saves the time.  So anything else that has the
+    database open (e.g. a notebook) can carry on reading it, and sees the data
+    from before the load until the load is committed.
+    The page cache is also doubled to 256 MiB for the duration.
+    The previous settings are restored when the block exits.
+
+    NB: Only use this when the data can be regenerated (e.g. populating the
+    database from the shot by shot summaries).  If the machine crashes part way
+    through, the database file may be left corrupted and need to be rebuilt.
+    """
+    conn = _get_conn()
+    synchronous = run_scalar("PRAGMA synchronous")
+    cache_size = run_scalar("PRAGMA cache_size")
+
+    #All the settings are changed inside the try, so that whatever has been
+    #changed is put back if any of them (or the load) fails.
+    try:
+        conn.execute("PRAGMA cache_size=-262144")
+        conn.execute("PRAGMA synchronous=OFF")
+
+        with connection():
+            yield conn
+    finally:
+        conn.execute("PRAGMA synchronous=" + str(synchronous))
+        conn.execute("PRAGMA cache_size=" + str(cache_size))
+
+
+def run_many(c, rows):
+    """
+    A function that takes a parameterized SQL command (using ? placeholders)
+    and a list of parameter tuples, and executes the command once for each
+    tuple on the curling_data database, all in a single transaction.
+    """
+    with connection() as conn:
+        conn.executemany(c, rows)
+
+
+@functools.lru_cache(maxsize = None)
+def _insert_sql(table, cols, n_rows):
+    """
+    Returns the text of an INSERT statement for n_rows rows of the given
+    columns of table, i.e. INSERT INTO table(cols) VALUES (?, ...), (?, ...).
+    Remembered, since bulk_insert() asks for the same few statements over and
+    over.
+    """
+    values = "(" + ", ".join(["?"] * len(cols)) + ")"
+    return ("INSERT INTO " + table + "(" + ", ".join(cols) + ") VALUES "
+            + ", ".join([values] * n_rows) + ";")
 
 
-def run_command(c):
+def bulk_insert(table, cols, rows):
     """
-    A function that takes an SQL command as an argument and executes it using
-    the sqlite module on the curling_data database.
+    A function that takes a table name, a sequence of column names and a list
+    of tuples of values for those columns, and inserts the rows into the table
+    of the curling_data database, all in a single transaction.
+
+    Rather than executing a one row INSERT for each row (as run_many would),
+    the rows are inserted as many at a time as will fit in one statement
+    (MAX_VARIABLES // len(cols) rows), with a multi-row VALUES list.  That way
+    sqlite has far fewer statements to step through.
     """
-    with sqlite3.connect(os.getenv("CADBPATH")) as conn:
-        conn.isolation_level = None
-        conn.execute(c)
+    cols = tuple(cols)
+    chunk_len = max(1, MAX_VARIABLES // len(cols))
+
+    with connection() as conn:
+        for start in range(0, len(rows), chunk_len):
+            chunk = rows[start:start + chunk_len]
+            conn.execute(_insert_sql(table, cols, len(chunk)),
+                    list(itertools.chain.from_iterable(chunk)))
+
+
+def drop_user_indexes():
+    """
+    Drops all the indexes that were created with CREATE INDEX (i.e. not the
+    ones sqlite makes itself for primary keys and UNIQUE constraints), and
+    returns a list of their CREATE INDEX statements, to be passed to
+    restore_indexes() once the bulk load is done.  Inserting into a table
+    updates every one of its indexes, so it is quicker to load the data and
+    then build the indexes once at the end.
+    """
+    q = """
+    SELECT name, sql FROM sqlite_master
+    WHERE type = 'index' AND name NOT LIKE 'sqlite_%' AND sql IS NOT NULL
+    """
+    indexes = run_rows(q)
+
+    for name, sql in indexes:
+        run_command('DROP INDEX "' + name + '"')
+
+    return [sql for name, sql in indexes]
+
+
+def restore_indexes(index_sql):
+    """
+    Recreates the indexes dropped by drop_user_indexes(), given the list of
+    CREATE INDEX statements it returned, and then runs ANALYZE so the query
+    planner has up to date statistics for the newly loaded tables.
+    """
+    for sql in index_sql:
+        run_command(sql)
+
+    run_command("ANALYZE")
+
 
 def get_next_id(table):
     """
     A function that when given the table name in question, returns the next
-    ID number for an entry in that table. (Just equal to the count of elements
-    in that table.)
+    ID number for an entry in that table.  IDs are assigned sequentially from
+    zero, so this is one more than the largest ID in the table (or zero if the
+    table is empty).
+
+    NB: MAX(id) on the INTEGER PRIMARY KEY is answered from the end of the
+    table's B-tree, so unlike COUNT(id) it does not scan the whole table.  It
+    is also a single value, so skip pandas and read it straight off the cursor.
+    """
+    q = """SELECT COALESCE(MAX(id) + 1, 0) FROM """ + table
+    return run_scalar(q)
+
+
+def pack_stone_positions(stones):
+    """
+    Given an iterable of (color, x, y) stone positions for one shot (at most
+    16 of them), returns the (red_mask, yellow_mask, coords) values for that
+    shot's row in the stone_positions_packed table.  Stone i goes in slot i of
+    coords, and bit i of the mask for its color is set.
+    """
+    red_mask = 0
+    yellow_mask = 0
+    coords = np.zeros((N_STONE_SLOTS, 2), dtype = "<f4")
+
+    for i, (color, x, y) in enumerate(stones):
+        if i >= N_STONE_SLOTS:
+            raise ValueError("More than " + str(N_STONE_SLOTS) + " stones in one shot.")
+
+        if color == "red":
+            red_mask |= 1 << i
+        elif color == "yellow":
+            yellow_mask |= 1 << i
+
+        coords[i] = (x, y)
+
+    return red_mask, yellow_mask, coords.tobytes()
+
+
+def unpack_stone_positions(red_mask, yellow_mask, coords):
+    """
+    The inverse of pack_stone_positions.  Given the red_mask, yellow_mask and
+    coords values of a stone_positions_packed row, returns a pandas dataframe
+    with the color, x and y of each stone, as in the stone_positions table.
     """
-    q = """SELECT COUNT(id) FROM """ + table
-    result_df = run_query(q)
-    return result_df.iloc[0,0]
+    import pandas as pd
+
+    xy = np.frombuffer(coords, dtype = "<f4").reshape(N_STONE_SLOTS, 2)
+    slots = np.arange(N_STONE_SLOTS)
+    is_red = (red_mask >> slots) & 1 == 1
+    is_yellow = (yellow_mask >> slots) & 1 == 1
+    in_use = is_red | is_yellow
 
+    return pd.DataFrame({"color":np.where(is_red, "red", "yellow")[in_use],
+        "x":xy[in_use, 0].astype(float), "y":xy[in_use, 1].astype(float)})
+
+
+def build_packed_stone_positions():
+    """
+    Fills (or refreshes) the stone_positions_packed table from the
+    stone_positions table, with one row for every shot in the shots table.
+    Shots with no stones in play get a row with both masks zero.
+    """
+    q = """
+    SELECT shots.id, stone_positions.color, stone_positions.x, stone_positions.y
+    FROM shots
+    LEFT JOIN stone_positions ON stone_positions.shot_id = shots.id
+    ORDER BY shots.id, stone_positions.id
+    """
+    rows = run_rows(q)
+
+    packed_rows = []
+    for shot_id, shot_rows in itertools.groupby(rows, key = lambda r: r[0]):
+        stones = [r[1:] for r in shot_rows if r[1] is not None]
+        packed_rows.append((shot_id,) + pack_stone_positions(stones))
+
+    c = """
+    INSERT OR REPLACE INTO stone_positions_packed (
+    shot_id,
+    red_mask,
+    yellow_mask,
+    coords)
+    VALUES (?, ?, ?, ?);
+    """
+    run_many(c, packed_rows)
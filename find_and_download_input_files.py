@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 
 """
-This script uses urllib and regular expressions to go through the contents of
+This script uses requests and an HTML parser to go through the contents of
 http://odf2.worldcurling.co/data/ and download the shot-by-shot summaries into
 an identical directory tree in /data in the current working directory.
 
@@ -10,174 +10,391 @@ Has the option of providing a single event short name on the command line to
 download just one event's worth of files.  (Useful both for downloading a newly
 added event, or for testing.
 
-Usage: python find_and_download_input_files.py (event_short_name)
+Usage: python find_and_download_input_files.py (event_short_name) [--jobs N]
+ [--rate N]
  event_short_name: Optional specification of one event to download.
+ --jobs N: The maximum number of requests to have in flight at once (defaults
+ to MAX_CONCURRENT_REQUESTS).
+ --rate N: The maximum number of requests to make per minute (defaults to
+ REQUESTS_PER_MINUTE).
 
 If no specific short name is supplied, it downloads all it can find by default.
 
-NB: A quick change was made to deal with some DNS issues crashing this script.
-The fix that was used can be found by searching for check_log_file in this
-script.  A more robust solution would be more advisable in the future.
+The crawl runs in three stages (find the session directories for each event,
+find the summaries in each session directory, download the summaries), and
+within each stage up to MAX_CONCURRENT_REQUESTS (or --jobs) requests are in
+flight at once.  The overall request rate is capped by a token bucket shared
+by all the threads (REQUESTS_PER_MINUTE, with bursts of up to REQUEST_BURST),
+so the server sees the same average rate as the old 10 second sleep between
+requests, but we are no longer idle while waiting on each response.
+
+All requests go through a single requests.Session, so connections to the
+server are reused (HTTP keep-alive) instead of being re-opened per request.
+Failed requests (including the DNS failures that used to crash this script
+part way through a crawl) are retried with an exponential backoff.  Host
+name lookups are also cached for the run, so we only go to DNS once for the
+server rather than every time a new connection is opened.
 
 """
-import sys
-import urllib.request
-import re
+import argparse
 import time
 import os
-
-#Start by checking whether we've been provided a single event_short_name to
-#process.  If so, put that in the directory list.  If not, get all of them.
-event_directory_list = []
-if len(sys.argv) > 1:
-    event_directory_list.append("/data/"+ sys.argv[1] + "/")
-
-else:
-
-    response = urllib.request.urlopen("http://odf2.worldcurling.co/data")
-    events_html = response.read()
-    
-    #This regular expression looks for strings wrapped in double-quotes that
-    #begin with /data/ and continues for the smallest number of characters
-    #possible before reaching a forward slash followed by double-quotation
-    #marks.  This is the format of the links on that page.  Note:  Not all of
-    #them will contain the files we are looking for, so we must incorporate
-    #checks along each step of the way.
-    #Only allow 20 characters for the short name.
-    #More than sufficient looking at the list, and prevents erroneous matches
-    #of this regular expression.
-    event_directory_list = re.findall('"/data/.{0,20}?/"', events_html.decode('utf-8'))
-
-#We don't want the quotation marks around the path for future use though, so
-#loop through and strip.
-for i in range(len(event_directory_list)):
-    event_directory_list[i] = event_directory_list[i].strip("\"")
-
-#Now that we have the list of all directories, we can get to work on
-#establishing whether they have shot-by-shot summaries, and what directory
-#structure we need to reproduce to store them, and pull down the summaries.
-
-#We experienced an issue during downloading, where a failed DNS request crashed
-#the program.  To pick up where we left off, at the "event" level check for
-#that event directory in the log file (indicates that it was already searched)
-#and if it has already been done, skip to the next event immediately.
-#Note: You may need to manually delete partial entries for the event in the
-#database.
-check_log_file = False
-
-#Comment out these lines if you want to do the log file check, and supply the
-#name of the log file here.
-#check_log_file = True
-#log_file = open("data_download.log", "r").read()
+import threading
+import socket
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+#The server all the data is stored on.
+BASE_URL = "http://odf2.worldcurling.co"
+
+#The maximum number of requests to have in flight at the same time.
+MAX_CONCURRENT_REQUESTS = 8
+
+#The maximum average number of requests per minute across all threads, so as
+#not to hammer the web page with requests, and the number of requests that can
+#be made back to back after the crawl has been idle.
+REQUESTS_PER_MINUTE = 6
+REQUEST_BURST = 6
 
 #Only considering the traditional men and women games.  These are the
 #directories they are stored under.
-game_types = ["Men\'s_Teams", "Women\'s_Teams"]
-for event_dir in event_directory_list:
-
-    #Before the delay, check whether this event is in the previous log-file.
-    if check_log_file and (event_dir in log_file):
-        print("Skipping previously handled event directory: " + event_dir, flush = True)
-        continue
-
-    #Before we continue, put in a 10 second delay so as not to hammer the web page
-    #with requests.
-    time.sleep(10)
+GAME_TYPES = ["Men\'s_Teams", "Women\'s_Teams"]
+
+#The number of seconds to wait for the server before giving up on a request.
+REQUEST_TIMEOUT = 30
+
+#The size of the pieces the PDF files are written to disk in (1 MiB).
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+#One session shared by all the download threads, so that connections are
+#pooled and reused.  Retry transient failures (connection and DNS errors, and
+#the server errors listed) with an exponential backoff.
+session = requests.Session()
+session.mount(BASE_URL, HTTPAdapter(pool_connections = 4,
+    pool_maxsize = 16, max_retries = Retry(total = 5, backoff_factor = 1,
+        status_forcelist = [429, 500, 502, 503, 504])))
+
+#The event directories are linked as /data/<short_name>/.  Only allow 20
+#characters for the short name.  More than sufficient looking at the list, and
+#prevents erroneous matches on other links.
+EVENT_PREFIX = "/data/"
+MAX_SHORT_NAME_LENGTH = 20
+
+#The shot by shot summaries are linked as <session_dir><game_code>_Shot_by_Shot_
+#...pdf, where the game code is at most 20 characters.
+SUMMARY_MARKER = "_Shot_by_Shot_"
+MAX_GAME_CODE_LENGTH = 20
+
+#The original, uncached, name lookup function.
+_getaddrinfo = socket.getaddrinfo
+
+#The directories that have already been created during this run.
+_created_dirs = set()
+
+
+@functools.lru_cache(maxsize = 64)
+def _cached_getaddrinfo(host, port, family, type, proto, flags):
+    """
+    The cached lookup behind cached_getaddrinfo.  Failed lookups raise, so they
+    are not cached and will be tried again.
+    """
+    return tuple(_getaddrinfo(host, port, family, type, proto, flags))
+
+
+def cached_getaddrinfo(host, port, family = 0, type = 0, proto = 0, flags = 0):
+    """
+    A drop-in replacement for socket.getaddrinfo that remembers the results of
+    previous lookups.
+    """
+    return list(_cached_getaddrinfo(host, port, family, type, proto, flags))
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket rate limiter.  Tokens are added at rate per
+    second, up to a maximum of capacity, and each call to acquire() takes one,
+    blocking until one is available.  This allows short bursts of up to
+    capacity requests while holding the long run average to rate.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                        self.tokens + (now - self.last_refill)*self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                #Not enough tokens yet, so work out how long until there are.
+                wait = (1 - self.tokens)/self.rate
+
+            time.sleep(wait)
+
+
+#The rate limiter shared between all the download threads.  main() replaces
+#this with one using the rate given on the command line.
+limiter = TokenBucket(REQUESTS_PER_MINUTE/60, REQUEST_BURST)
+
+
+def request(method, path, stream = False):
+    """
+    Waits for the rate limiter, then sends a request with the given method
+    (e.g. "GET") for the given path on the server and returns the response.
+    If stream is True, the body is not downloaded until it is read from the
+    response.
+    """
+    limiter.acquire()
+
+    req_string = BASE_URL + path
+    print("Requesting (" + method + ") " + req_string, flush = True)
+    response = session.request(method, req_string, timeout = REQUEST_TIMEOUT,
+            stream = stream)
+    response.raise_for_status()
+    return response
+
+
+def get(path, stream = False):
+    """
+    Sends a GET request for the given path on the server and returns the
+    response.
+    """
+    return request("GET", path, stream = stream)
+
+
+def is_already_downloaded(summary, out_path):
+    """
+    Returns True if the summary has already been saved to out_path in full,
+    i.e. the local file exists and is the same size as the Content-Length the
+    server reports for it in response to a HEAD request.  If the server doesn't
+    report a size, or the HEAD request fails (some servers don't support it, or
+    return errors for it), assume the file needs downloading again.
+    """
+    if not os.path.exists(out_path):
+        return False
+
+    try:
+        response = request("HEAD", summary)
+    except requests.RequestException:
+        return False
+
+    content_length = response.headers.get("Content-Length")
+    if content_length is None:
+        return False
+
+    return int(content_length) == os.path.getsize(out_path)
+
+
+class LinkParser(HTMLParser):
+    """
+    An HTML parser that collects the href attribute of every <a> tag in the
+    document, in order, in its links attribute.
+    """
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            for name, value in attrs:
+                if name == "href" and value is not None:
+                    self.links.append(value)
+
+
+def get_links(path):
+    """
+    Requests the given directory listing page on the server and returns the
+    list of all the links on it.
+    """
+    parser = LinkParser()
+    parser.feed(get(path).content.decode('utf-8'))
+    parser.close()
+    return parser.links
+
+
+def is_summary_link(link, session_dir):
+    """
+    Returns True if the link points to a shot by shot summary PDF inside the
+    given session directory.
+    """
+    if not (link.startswith(session_dir) and link.endswith(".pdf")):
+        return False
+
+    marker_index = link.find(SUMMARY_MARKER, len(session_dir))
+    return 0 <= marker_index - len(session_dir) <= MAX_GAME_CODE_LENGTH
+
+
+def find_session_dirs(event_dir):
+    """
+    Given an event directory (e.g. /data/<short_name>/), returns the list of
+    session directory paths for all the game types we are interested in that
+    exist for this event.
+    """
+    session_dirs = []
 
     #Start by requesting this event directory.
-    req_string = "http://odf2.worldcurling.co" + event_dir
-    print("Searching " + req_string, flush = True)
-    response = urllib.request.urlopen(req_string)
-    types_html = response.read()
+    type_links = get_links(event_dir)
 
     #Now, loop over the game types.
-    for gt in game_types:
+    for gt in GAME_TYPES:
+        gt_dir = event_dir + gt + "/"
 
         #Only request the next level of this directory tree if that game type
         #directory exists.
-        if re.search(gt, types_html.decode('utf-8')):
-
-            #First, add in the 10 second delay for the server.
-            time.sleep(10)
+        if any(link.startswith(gt_dir) for link in type_links):
 
             #Now, pull this game type's directory.
-
-            req_string = "http://odf2.worldcurling.co" + event_dir + gt + "/"
-            print("Searching " + req_string, flush = True)           
-            response = urllib.request.urlopen(req_string)
-
-            sessions_html = response.read()
-
-            #Now, the subdirectories on this page are the ones that contain the
-            #shot by shot summaries.  So get an array of subdirectories to
+            #The subdirectories on this page are the ones that contain the
+            #shot by shot summaries.  So get a list of subdirectories to
             #traverse.
-            session_dirs = re.findall('"' + event_dir + gt + '/.*?/"',sessions_html.decode('utf-8'))
-
-            #session_dirs should now contain the full path to all the different
-            #session directories.  Loop through them, request each page, get
-            #the list of shot by shot summaries, and download them to the same
-            #directory structure starting in the current working directory.
-            for path in session_dirs:
-
-                #Delay 10 seconds for the server.
-                time.sleep(10)
-
-                #Remember to strip out the extra quotations in the path.
-                path = path.strip("\"")
-                
-                req_string = "http://odf2.worldcurling.co" + path
-                print("Searching " + req_string, flush = True)
-                response = urllib.request.urlopen(req_string)
-                pdfs_html = response.read()
-
-                summary_paths = re.findall('"' + path + '.{0,20}?_Shot_by_Shot_.*?.pdf"',pdfs_html.decode('utf-8'))
-                
-                #Now, if summary_paths is not empty, verify (or create) the
-                #directory structure we need to save those files.
-                #Get the full directory structure by splitting this
-                #string on the forward slash.
-                #Strip off any leading and trailing forward slashes, so
-                #this list only contains various names, and no empty
-                #strings.
-                #dir_path stores the path as we go deeper into the directory
-                #structure.
-                if(len(summary_paths) == 0):
-                    print("No summary files found.  Switching to new directory.", flush = True)
-                    continue
-                else:
-                    print(str(len(summary_paths)) + " summary files found. Saving...", flush = True)
-
-
-                dir_list = path.strip("/").split("/")
-                dir_path = ""
-                for dir_name in dir_list:
-                    if not os.path.exists(dir_path + dir_name):
-                        os.mkdir(dir_path + dir_name)
-
-                    dir_path += dir_name + "/"
-
-                
-                #Now, loop through the summary paths and save each file to its
-                #place in the directory structure.
-                for summary in summary_paths:
-
-                    #First, remove any extra quotation marks.
-                    summary = summary.strip("\"")
-
-                    #Now, open the url and read the file, after a 10 second
-                    #delay.
-                    time.sleep(10)
-                    response = urllib.request.urlopen("http://odf2.worldcurling.co" + summary)
-                    pdf_file = response.read()
-
-                    #Now, create the output file.
-                    #The "w" option is for "write"
-                    #The "b" option is for "bytes", which is what the PDF comes
-                    #as in the response.
-                    #And initial and trailing slashs from summary to get the
-                    #right path.
-                    out_file = open(summary.strip("/"), "wb")
-                    out_file.write(pdf_file)
-                    out_file.close()
-
-
+            for link in get_links(gt_dir):
+                if (link.startswith(gt_dir) and link.endswith("/")
+                        and len(link) > len(gt_dir)):
+                    session_dirs.append(link)
+
+    return session_dirs
+
+
+def find_summaries(path):
+    """
+    Given a session directory path, returns the list of paths to the shot by
+    shot summaries stored there.
+    """
+    summary_paths = [link for link in get_links(path)
+            if is_summary_link(link, path)]
+
+    if(len(summary_paths) == 0):
+        print("No summary files found in " + path, flush = True)
+        return []
+    else:
+        print(str(len(summary_paths)) + " summary files found in " + path, flush = True)
+
+    return summary_paths
+
+
+def make_dirs(dir_path):
+    """
+    Makes sure the given directory (and all its parents) exist on the hard
+    drive.  Directories already made during this run are remembered, so we only
+    go to the file system once per directory rather than once per file.
+    NB: Several threads may be creating the same parent directories at once,
+    so exist_ok=True matters here.
+    """
+    if dir_path not in _created_dirs:
+        os.makedirs(dir_path, exist_ok = True)
+        _created_dirs.add(dir_path)
+
+
+def download_summary(summary):
+    """
+    Downloads a single shot by shot summary and saves it to the same place in
+    the directory structure relative to the current working directory.
+    Summaries that are already on the hard drive in full are skipped, so a
+    re-run (e.g. after a crash, or to pick up new events) only downloads what is
+    missing or incomplete.
+    """
+    #And initial and trailing slashs from summary to get the
+    #right path.
+    out_path = summary.strip("/")
+    if is_already_downloaded(summary, out_path):
+        print("Already downloaded: " + out_path, flush = True)
+        return
+
+    make_dirs(os.path.dirname(out_path))
+    with get(summary, stream = True) as response:
+
+        #Now, create the output file.
+        #The "w" option is for "write"
+        #The "b" option is for "bytes", which is what the PDF comes
+        #as in the response.
+        #Stream the body to the file in DOWNLOAD_CHUNK_SIZE pieces, rather
+        #than holding the whole PDF in memory before writing it out.
+        with open(out_path, "wb") as out_file:
+            for chunk in response.iter_content(chunk_size = DOWNLOAD_CHUNK_SIZE):
+                out_file.write(chunk)
+
+
+def main(event = None, jobs = MAX_CONCURRENT_REQUESTS, rate = REQUESTS_PER_MINUTE):
+    """
+    Downloads all the shot by shot summaries on the server (or just those for
+    one event, if its short name is given), with up to jobs requests in
+    flight at once and at most rate requests per minute on average.
+    """
+    global limiter
+    limiter = TokenBucket(rate/60, REQUEST_BURST)
+
+    #Every connection opened by requests goes through socket.getaddrinfo, so
+    #install the cached version in its place.
+    socket.getaddrinfo = cached_getaddrinfo
+
+    #Start by checking whether we've been provided a single event_short_name to
+    #process.  If so, put that in the directory list.  If not, get all of them.
+    event_directory_list = []
+    if event is not None:
+        event_directory_list.append("/data/"+ event + "/")
+
+    else:
+
+        #The event directories are the links that begin with /data/ and end with
+        #a forward slash.  Note:  Not all of them will contain the files we are
+        #looking for, so we must incorporate checks along each step of the way.
+        for link in get_links("/data"):
+            short_name_length = len(link) - len(EVENT_PREFIX) - 1
+            if (link.startswith(EVENT_PREFIX) and link.endswith("/")
+                    and 0 <= short_name_length <= MAX_SHORT_NAME_LENGTH):
+                event_directory_list.append(link)
+
+    #Now that we have the list of all directories, we can get to work on
+    #establishing whether they have shot-by-shot summaries, and what directory
+    #structure we need to reproduce to store them, and pull down the summaries.
+    #Each stage is fanned out over the thread pool, and finishes before the next
+    #one starts.
+    with ThreadPoolExecutor(max_workers = jobs) as executor:
+
+        session_dirs = [path for dirs in executor.map(find_session_dirs,
+            event_directory_list) for path in dirs]
+
+        summary_paths = [summary for summaries in executor.map(find_summaries,
+            session_dirs) for summary in summaries]
+
+        list(executor.map(download_summary, summary_paths))
+
+
+def positive_float(value):
+    """
+    An argparse type for options that must be a number greater than zero
+    (e.g. the request rate, which the rate limiter divides by).
+    """
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError("must be greater than zero, got "
+                + value)
+
+    return number
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Download the shot by shot "
+            "summaries from " + BASE_URL + "/data/.")
+    parser.add_argument("event", nargs = "?", default = None,
+            help = "The short name of a single event to download.")
+    parser.add_argument("--jobs", type = int, default = MAX_CONCURRENT_REQUESTS,
+            help = "The maximum number of requests to have in flight at once.")
+    parser.add_argument("--rate", type = positive_float, default = REQUESTS_PER_MINUTE,
+            help = "The maximum number of requests to make per minute.")
+    args = parser.parse_args()
+
+    main(args.event, args.jobs, args.rate)
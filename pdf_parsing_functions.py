@@ -6,11 +6,31 @@ The various functions we need to parse the PDF files and extract the data they
 contain are defined and implemented here.
 """
 
+import re
+import functools
 import numpy as np
 import pandas as pd
 import xml.etree.ElementTree as ET
 import cv2
 
+#lxml's parser is faster than the standard library's, so use it for reading
+#the documents if it's installed.  Its elements have the same interface as
+#ElementTree's, so nothing else needs to know which one we have.
+try:
+    from lxml import etree as _lxml_etree
+except ImportError:
+    _lxml_etree = None
+
+#"team: player name" in the shot data.  The team is everything before the
+#first colon, and the player name everything between it and the next colon (if
+#there is one).
+_TEAM_RE = re.compile(r"([^:]*):([^:]*)")
+
+#A percent score is a whole number, possibly with percent signs (or
+#backslashes) before or after it.  Anything else isn't a usable score.
+_PERCENT_RE = re.compile(r"[\\%]*(\d+)[\\%]*")
+
+
 def get_rock_positions(image_path):
     """
     Given a path to the standard sheet overview (image_path) as a string, returns a
@@ -24,24 +44,40 @@ def get_rock_positions(image_path):
     coordinate system (origin at the center of the button) and extract the
     direction of play, as well as remove the rocks that are out of play or yet
     to be thrown.
+
+    The same image often turns up for more than one shot (e.g. when no rocks
+    moved), and each shot's image is its own file, so the results are cached
+    by the contents of the file rather than by its path.  The DataFrame
+    returned is a copy, so callers are free to modify it.
     """
-    
-    #The discussion here indicates that assembling a list of dicts for each row
-    #is a pretty fast way of getting a structure we can easily convert to a
-    #DataFrame.  So set that up now:
-    #https://stackoverflow.com/questions/10715965/add-one-row-to-pandas-dataframe
-    row_list = []
+    with open(image_path, "rb") as image_file:
+        png = image_file.read()
+
+    return _get_rock_positions_from_png(png).copy()
 
-    #Dictionary keys will be ["color", "x", "y", "size"] 
 
+@functools.lru_cache(maxsize = 256)
+def _get_rock_positions_from_png(png):
+    """
+    Does the work for get_rock_positions, given the contents of the image file
+    (png), as bytes.  The results are cached, so must not be modified.
+    """
 
-    #Start by reading in the image.
-    img = cv2.imread(image_path)
+    #Start by decoding the image, straight to 8 bit BGR.
+    img = cv2.imdecode(np.frombuffer(png, dtype = np.uint8), cv2.IMREAD_COLOR)
 
     #Convert this to a binary image for each stone color.
-    #(White where the stones are, black everywhere else).
-    #Red stones are just solid red circles
-    red_bin = cv2.inRange(img, (0, 0, 255), (0, 0, 255))
+    #(Non-zero where the stones are, zero everywhere else).
+    #Each color range is checked with NumPy comparisons directly on the
+    #blue, green and red planes of the image, with the boolean mask viewed as
+    #uint8 for OpenCV (no copy).
+    #The image is split into its planes once up front, so each plane is
+    #contiguous and each comparison only reads the one channel it needs,
+    #rather than striding through the interleaved image.
+    B, G, R = cv2.split(img)
+
+    #Red stones are just solid red circles: (B,G,R) = (0,0,255)
+    red_bin = ((B == 0) & (G == 0) & (R == 255)).view(np.uint8)
 
     #Yellow stones that have been thrown already are yellow circles that also
     #have an X in them that is part blue and part greyish-yellow.  So that the
@@ -52,8 +88,10 @@ def get_rock_positions(image_path):
     #(0,193,255).  Should still be specific enough not to trigger on the house.
     #In this case, blue takes on a little bit of green too.
     #Also need to expand greyish-yellow out to allow (0, 178, 239)
-    yellow_bin = cv2.inRange(img, (0,192,255), (0,255,255))
-    blue_bin = cv2.inRange(img, (255,0,0),(255,63,0))
+    #Yellow: (0,192,255) to (0,255,255)
+    #Blue: (255,0,0) to (255,63,0)
+    yellow_bin = (B == 0) & (G >= 192) & (R == 255)
+    blue_bin = (B == 255) & (G <= 63) & (R == 0)
     
     #Greyish-yellow appears to employ two shades in some instances.  Use them
     #as the bounds of the range.
@@ -62,21 +100,44 @@ def get_rock_positions(image_path):
     #Increse G by 1 for another shade of grey found (sometimes (rarely) a black X is
     #used through the yellow stones.  Adding black is problematic for this
     #algorithm though (triggers on all the lines), so will not do that.
-    greyish_yellow_bin = cv2.inRange(img, (0,164,207), (32,224,239))
+    #Greyish-yellow: (0,164,207) to (32,224,239)
+    greyish_yellow_bin = ((B <= 32) & (G >= 164) & (G <= 224) & (R >= 207)
+            & (R <= 239))
     
-    yellow_rocks = cv2.bitwise_or(yellow_bin, cv2.bitwise_or(blue_bin,
-        greyish_yellow_bin))
-
-    #Loop over red and yellow, and fill the row_list, one rock position per
-    #row.
+    #The three yellow masks are ORed together as booleans, in place into the
+    #first one, so no new image sized arrays are allocated.  Only the result
+    #is viewed as uint8 for OpenCV.
+    yellow_rocks = yellow_bin
+    yellow_rocks |= blue_bin
+    yellow_rocks |= greyish_yellow_bin
+    yellow_rocks = yellow_rocks.view(np.uint8)
+
+    #Loop over red and yellow, and get the list of rock contours for each
+    #color.
     rock_bin_dict = {"red":red_bin, "yellow":yellow_rocks}.items()
+    rocks_by_color = []
     for color, rock_bin in rock_bin_dict:
 
-        #Get the contours, using RETR_TREE so can use hierarchy to remove contours within
-        #contours (unfilled circles denoting positions of rocks that were
-        #moved)
+        #Get the contours, using RETR_TREE so can use hierarchy to remove
+        #contours within contours (unfilled circles denoting positions of rocks
+        #that were moved).
+        #NB: This needs the full tree.  RETR_CCOMP's two level hierarchy puts
+        #anything inside a hole (e.g. a rock sitting inside a former position's
+        #ring) back at the top level with no parent, so it would be kept as a
+        #rock.
+        #We only use the contours for their moments, which OpenCV computes
+        #exactly from the polygon, so CHAIN_APPROX_SIMPLE (which drops the
+        #points in the middle of straight runs of the boundary) gives the same
+        #results as storing every boundary pixel.
         contours, hierarchy = cv2.findContours(rock_bin, cv2.RETR_TREE,
-                cv2.CHAIN_APPROX_NONE)
+                cv2.CHAIN_APPROX_SIMPLE)
+        #NB: cv2.connectedComponentsWithStats would give the centroids and
+        #sizes without the contours, but it can't be used here.  Its areas are
+        #pixel counts rather than the contour areas that the size cuts in
+        #clean_rock_positions and get_1st_shot_color were tuned on, and it has
+        #no hierarchy, so the unfilled circles of former rock positions would
+        #come through as rocks.  The two colors also can't share one pass, as
+        #touching red and yellow rocks would merge into a single contour.
 
         #We want to remove all contours that have contours within them or are
         #within contours, as these are former positions of rocks, which we
@@ -84,27 +145,48 @@ def get_rock_positions(image_path):
         #Such contours have parents or children (the last 2 entries in the
         #hierarchy for the contour), so we need to only keep contours whose
         #last 2 hierarchy numbers are both -1.
-        only_rocks = np.array(contours)[np.all(hierarchy[0,:,2:4] == -1,
-            axis=1)]
-
-        #Finally, loop over the remaining contours in only_rocks and get the
-        #centroids to get the rock positions, appending them with their color
-        #to row_list.
-        #Note: In the case of partial rock previous positions, the area, M['m00'],
-        #comes up as zero.  To guard against division by zero, divide by the
-        #maximum of M['m00'] and 1.
-        for cnt in only_rocks:
-            M = cv2.moments(cnt)
-            cx = M['m10']/max(M['m00'], 1)
-            cy = M['m01']/max(M['m00'], 1)
-
-            row_list.append({"color":color, "x":cx, "y":cy, "size":M['m00']})
-
-
+        #NB: contours is a list of arrays of different lengths, so select from
+        #it directly rather than wrapping it in a (ragged) NumPy array.
+        h = hierarchy[0]
+        keep = (h[:,2] == -1) & (h[:,3] == -1)
+        only_rocks = [contours[i] for i in np.flatnonzero(keep)]
+
+        rocks_by_color.append((color, only_rocks))
+
+    #Now that we know how many rocks there are, preallocate the output color
+    #array, and an array for the moments we need: the area (the rock size) and
+    #the first moments for the centroids (the rock positions), one row per
+    #rock.  ("yellow" is the longest color name, so 6 characters is enough.)
+    n_rocks = sum(len(only_rocks) for color, only_rocks in rocks_by_color)
+    rock_color = np.empty(n_rocks, dtype = "U6")
+    moments = np.empty((n_rocks, 3))
+
+    #The rocks of each color are contiguous, so fill in the color and the
+    #moments a block at a time.  The only Python work per rock is pulling the
+    #three moments out of the dict cv2.moments returns; the arithmetic is all
+    #done on the whole array below.
+    i = 0
+    for color, only_rocks in rocks_by_color:
+        n_color = len(only_rocks)
+        rock_color[i:i + n_color] = color
+        for j, M in enumerate(map(cv2.moments, only_rocks)):
+            moments[i + j] = (M['m00'], M['m10'], M['m01'])
+        i += n_color
+
+    #The centroid is (m10/m00, m01/m00), done for all rocks at once.
+    #Note: In the case of partial rock previous positions, the area, M['m00'],
+    #comes up as zero.  To guard against division by zero, divide by the
+    #maximum of M['m00'] and 1.
+    rock_size = moments[:, 0]
+    safe_size = np.maximum(rock_size, 1)
+    rock_x = moments[:, 1] / safe_size
+    rock_y = moments[:, 2] / safe_size
 
     #Now that we've looped over both colors and all rocks with those colors,
-    #turn the row_list to a DataFrame and return it.
-    return pd.DataFrame(row_list)
+    #turn the columns into a DataFrame and return it.  The arrays are already
+    #of the right types, so pandas can use them as they are.
+    return pd.DataFrame({"color":rock_color, "x":rock_x, "y":rock_y,
+        "size":rock_size}, copy = False)
 
 
 def get_direction_of_play(rock_df):
@@ -122,8 +204,9 @@ def get_direction_of_play(rock_df):
     This is done by counting whether there are more stones in the top 20 pixels
     of the sheet, or the bottom 20 pixels of the sheet.
     """
-    n_top_20 = (rock_df["y"] < 20).sum()
-    n_bottom_20 = (rock_df["y"] > 579).sum()
+    y = rock_df["y"].to_numpy()
+    n_top_20 = np.count_nonzero(y < 20)
+    n_bottom_20 = np.count_nonzero(y > 579)
 
     #If there are more at the top than the bottom after the first shot, it's
     #"down"
@@ -158,7 +241,8 @@ def clean_rock_positions(rock_df, direction):
     interested in coordinates based on real measurements, that can be done in
     post-processing using the various house coordinates.
 
-    This function returns the modified DataFrame.
+    This function returns a new DataFrame, and does not modify the one passed
+    in.
 
     The images are all 300x600, so 0-299 in x, and 0-599 in y. 
     """
@@ -172,10 +256,18 @@ def clean_rock_positions(rock_df, direction):
     #account by using the centre of the button (the "pin") as the reference point, as this
     #becomes the origin.
     #This is the value for "down"
+    #NB: All the arithmetic and cuts below are done on NumPy arrays pulled out
+    #of the DataFrame once, and the output DataFrame is built once at the end,
+    #so the DataFrame passed in is left unchanged.
+    color = rock_df["color"].to_numpy()
+    x = rock_df["x"].to_numpy()
+    y = rock_df["y"].to_numpy()
+    size = rock_df["size"].to_numpy()
+
     pin = (149, 439)
     if direction == "up":
-        rock_df["x"] = 299 - rock_df["x"]
-        rock_df["y"] = 599 - rock_df["y"]
+        x = 299 - x
+        y = 599 - y
         
         #This is where the pin is in a flipped "up".
         pin = (150, 440)
@@ -187,7 +279,6 @@ def clean_rock_positions(rock_df, direction):
     #NB: This cut also removes partial contours of previous rock positions that
     #intersect with current rock positions (leading to an incomplete hollow
     #circle, that contour detection sees as a small enclosed region.
-    rock_df = rock_df[rock_df["size"] > 100]
 
     #All the rocks that have gone out of play get lined up along the bottom
     #line.  Also need to be careful here, since rocks still in contact with the
@@ -195,28 +286,29 @@ def clean_rock_positions(rock_df, direction):
     #deep, and rocks are approximately 8 pixels in radius, so cutting any rock
     #with a centroid with y >= 580 should provide sufficient wiggle room on both
     #sides.
-    rock_df = rock_df[rock_df["y"] < 580]
+    #Both cuts are combined into a single mask, so each column is only sliced
+    #once.
+    keep = (size > 100) & (y < 580)
+    color = color[keep]
+    x = x[keep]
+    y = y[keep]
     
     
     #Since we're remaining in pixel coordinates, change to the pin-centric
     #coordinate system now.
     #For x runs from 0 to 299 left to right, so just need to subtract the pin
     #x position for the correct x coordinate.
-    rock_df["x"] = rock_df["x"] - pin[0]
+    x = x - pin[0]
 
     #y runs from 0-599 top to bottom, so need to subtract the y position from
     #the y pin position to flip the orientation.
-    rock_df["y"] = pin[1] - rock_df["y"]
+    y = pin[1] - y
 
 
-    #We don't need the rock size in our dataset, so remove that column.
-    rock_df = rock_df.drop(columns=["size"])
-    
-    #Also, reset the index so that it is sequential from zero for the rocks
-    #that we do have in play.
-    rock_df = rock_df.reset_index(drop=True)
-    
-    return rock_df
+    #We don't need the rock size in our dataset, so leave that column out of
+    #the output.  The new DataFrame's index is sequential from zero for the
+    #rocks that we do have in play.
+    return pd.DataFrame({"color":color, "x":x, "y":y}, copy = False)
 
 
 def get_1st_shot_color(df):
@@ -231,9 +323,12 @@ def get_1st_shot_color(df):
     #Since we only use this on the first shot, there cannot be any previously
     #played rock positions, so this cut can only possibly select the unthrown
     #rocks.
-    rock_df = df[df["size"] < 100]
-    n_red = rock_df["color"][rock_df["color"] == "red"].count()
-    n_yellow = rock_df["color"][rock_df["color"] == "yellow"].count()
+    #Then count how many of them there are of each color in one pass.
+    unthrown_colors = df["color"].to_numpy()[df["size"].to_numpy() < 100]
+    colors, counts = np.unique(unthrown_colors, return_counts = True)
+    color_counts = dict(zip(colors, counts))
+    n_red = color_counts.get("red", 0)
+    n_yellow = color_counts.get("yellow", 0)
     
     if n_red == 7:
         return "red"
@@ -244,90 +339,166 @@ def get_1st_shot_color(df):
         return "color_error"
 
 
-def get_date_and_time(page):
+def index_page(page):
     """
-    Given a page from the xml file, pulls out the date and time of the game and
-    returns them as a dict with keys ["date", "time"].
+    Given a page from the xml file, goes through its elements once and returns
+    a dict with everything the functions below need to know about the page's
+    text elements, so that each of them doesn't have to loop over the page and
+    convert the positions to integers again.  The dict has keys:
+        -"index": A NumPy array of the index in the page of each text element
+        (in ascending order).
+        -"left": A NumPy array of the left position of each text element.
+        -"top": A NumPy array of the top position of each text element.
+        -"text": A list of the text of each text element (taken from the <b>
+        </b> tag inside it if it is bold, and "" if it has no text).
+        -"text_array": The same text as a NumPy string array.
+        -"elts": A list of the text elements themselves.
+    The entries of each of these correspond to each other.  There are also:
+        -"top_order": The indices into the arrays above that sort the
+        elements by top (keeping page order for equal tops).
+        -"top_sorted": The top positions in that order, for binary searches.
+
+    Only text elements are included, as the other element types are not
+    guaranteed to have the positioning attributes.
+
+    The result can be passed to get_date_and_time, get_shot_data,
+    get_score_and_time, get_name_and_sheet and get_game_header as their
+    page_index argument.  If it is not, they call this themselves.
     """
-    
-    #Loop over all the elements in the page to find the start time,
-    #and save its value along with its left and top positions, and its index
-    #number so we can identify it when checking for the start_date.
-    start_time = ""
-    start_time_left = 0
-    start_time_top = 0
-    start_time_index = 0
-   
+    index = []
+    elts = []
+    text = []
+    for i, elt in enumerate(page):
 
-    for i in range(len(page)):
-        
-        elt = page[i]
-        
         #If this isn't a text element, continue to the next one.
         if elt.tag != "text":
             continue
 
         #If the length of the elt is equal to 1, it means that there is a <b>
-        #</b> tag that indicates bold in the original PDF.  In that case, do
-        #elt[0] instead of elt.
+        #</b> tag that indicates bold in the original PDF.  In that case, take
+        #the text from elt[0] instead of elt.
         #NB:  Still need to retain elt for the attribute information.
         text_elt = elt
-        if(len(elt) == 1):
+        if len(elt) == 1:
             text_elt = elt[0]
 
+        index.append(i)
+        elts.append(elt)
+        text.append(text_elt.text or "")
 
-        #The element with the start time contains "Start Time".  If we find
-        #this element, save the information we need then break out of the loop.
-        if "Start Time" in text_elt.text:
+    #Convert the positions straight into int32 arrays of known length, without
+    #building intermediate lists.
+    n_elts = len(elts)
+    left = np.fromiter((int(elt.attrib["left"]) for elt in elts),
+            dtype = np.int32, count = n_elts)
+    top = np.fromiter((int(elt.attrib["top"]) for elt in elts),
+            dtype = np.int32, count = n_elts)
 
-            #If we split this text by space, the actual time is the last
-            #element.
-            start_time = (text_elt.text).split(" ")[-1]
-            start_time_left = int(elt.attrib["left"])
-            start_time_top = int(elt.attrib["top"])
-            start_time_index = i
+    #Sort by top once per page, so that get_shot_data can find the elements
+    #in a band of top positions with a binary search.
+    top_order = np.argsort(top, kind = "stable")
 
-            break
+    #Also keep the text as a NumPy string array, so that the searches for the
+    #labels can be done on the whole page at once.
+    text_array = np.array(text, dtype = str)
 
-    #Now, loop through the elements again.  Find the first element with the
-    #same left value, and a top value that is less than 30 below that of the
-    #start time (the date has the same left justification, but is slightly
-    #above the time.)
-    game_date = ""
-    for i in range(len(page)):
-        
-        #If this is the start time element, continue.
-        if i == start_time_index:
-            continue
-        
-        elt = page[i]
-       
-        #If this isn't a text element, continue to the next one.
-        if elt.tag != "text":
-            continue
+    return {"index":np.fromiter(index, dtype = np.int64, count = n_elts),
+            "left":left, "top":top, "text":text, "text_array":text_array,
+            "elts":elts, "top_order":top_order, "top_sorted":top[top_order]}
 
-        #If the length of the elt is equal to 1, it means that there is a <b>
-        #</b> tag that indicates bold in the original PDF.  In that case, do
-        #elt[0] instead of elt.
-        #NB:  Still need to retain elt for the attribute information.
-        text_elt = elt
-        if(len(elt) == 1):
-            text_elt = elt[0]
 
+def get_date_and_time(page, page_index = None):
+    """
+    Given a page from the xml file, pulls out the date and time of the game and
+    returns them as a dict with keys ["date", "time"].
 
-        elt_left = int(elt.attrib["left"])
-        elt_top = int(elt.attrib["top"])
+    Optionally takes the output of index_page for the page, if it has already
+    been computed.
+    """
+    if page_index is None:
+        page_index = index_page(page)
+
+    index = page_index["index"]
+    left = page_index["left"]
+    top = page_index["top"]
+    text = page_index["text"]
+
+    #Find the first text element in the page with the start time, and save its
+    #value along with its left and top positions, and its index number so we
+    #can identify it when checking for the start_date.
+    #If there isn't one, the start time stays blank and the date is looked for
+    #relative to position (0,0).
+    start_time = ""
+    start_time_left = 0
+    start_time_top = 0
+    start_time_index = 0
 
-        #If the positioning indicates it's the date element, fill in the date
-        #info.
-        if (elt_left == start_time_left) and (abs(start_time_top - elt_top) < 30):
-            game_date = text_elt.text
-            break
+    #The element with the start time contains "Start Time".  Search all the
+    #text for it at once, and take the first match.
+    start_time_k = np.flatnonzero(
+            np.char.find(page_index["text_array"], "Start Time") >= 0)
+    if len(start_time_k) > 0:
+        k = start_time_k[0]
+
+        #If we split this text by space, the actual time is the last
+        #element.
+        start_time = text[k].split(" ")[-1]
+        start_time_left = left[k]
+        start_time_top = top[k]
+        start_time_index = index[k]
+
+    #Now, find the first other element with the same left value, and a top
+    #value that is less than 30 below that of the start time (the date has the
+    #same left justification, but is slightly above the time.)  All the
+    #elements are checked at once.
+    is_date = ((left == start_time_left) & (np.abs(start_time_top - top) < 30)
+            & (index != start_time_index))
+    date_k = np.flatnonzero(is_date)
+
+    game_date = ""
+    if len(date_k) > 0:
+        game_date = text[date_k[0]]
 
     return {"date":game_date, "time":start_time}
 
 
 
+def iter_pages(xml_path):
+    """
+    Given the path to an xml file produced by pdftohtml, yields its pages (in
+    order) as they are parsed, rather than reading the whole file in first.
+
+    Each page is only valid until the next one is requested: once the caller
+    is done with it, it is cleared and dropped from the document, so that only
+    one page is held in memory at a time.
+
+    The file is parsed with lxml if it's available (with no limit on the size
+    of text nodes, and without building a table of the documents' ids, which
+    we don't use), otherwise with the standard library's parser.
+    """
+    if _lxml_etree is not None:
+        events = _lxml_etree.iterparse(xml_path, events = ("start", "end"),
+                huge_tree = True, collect_ids = False)
+    else:
+        events = ET.iterparse(xml_path, events = ("start", "end"))
+
+    root = None
+    for event, elt in events:
+
+        #The first element to start is the document's root element, which the
+        #pages are children of.
+        if root is None:
+            root = elt
+
+        if event == "end" and elt.tag == "page":
+            yield elt
+
+            #Free the page, and remove it (and anything before it) from the
+            #root.
+            elt.clear()
+            root.clear()
+
+
 def get_image_list(page):
     """
     Goes through a page and returns (in order) all elements for images in the page if the
@@ -338,21 +509,17 @@ def get_image_list(page):
     image_width = 116
     image_height = 232
 
-    image_list = []
-    for i in range(len(page)):
-
-        if ((page[i].tag == "image") 
-                and (int(page[i].attrib["width"]) == 116)
-                and (int(page[i].attrib["height"]) == 232)):
+    #iterfind only yields the image elements (in order), so there's no need to
+    #check the tag of every element in the page.
+    return [elt for elt in page.iterfind("image")
+            if ((int(elt.attrib["width"]) == image_width)
+                and (int(elt.attrib["height"]) == image_height))]
 
-            image_list.append(page[i])
 
-    return image_list
 
 
-
-
-def get_shot_data(page, shot, image_list, prev_max_elt_index = 0):
+def get_shot_data(page, shot, image_list, prev_max_elt_index = 0,
+        page_index = None):
     """
     Given a page from the xml file, the shot number under consideration, and
     the image attributes array for all the stone position images after each
@@ -390,9 +557,13 @@ def get_shot_data(page, shot, image_list, prev_max_elt_index = 0):
     so only write out team and player name, which is all the information
     typically included here. (The other two entries in this case are "no
     statistics" and "-".
-    
+
+    Also optionally takes the output of index_page for the page, if it has
+    already been computed.
     """
-    
+    if page_index is None:
+        page_index = index_page(page)
+
     #image_list is a list of the stone elements in ascending order, as
     #selected elsewhere by the image size (all stone images are 116 wide by 232
     #in height.
@@ -402,50 +573,50 @@ def get_shot_data(page, shot, image_list, prev_max_elt_index = 0):
     top_bound = int(elt_shot_image.attrib["top"]) + int(elt_shot_image.attrib["height"])
     bottom_bound = top_bound + 30
 
-    #Store the elements that satisfy the boundary conditions in a dictionary by
-    #index number, for easy extraction of the maximum index.
-    elt_dict = {}
-
-    #Loop over the elements in the page, starting at prev_max_elt_index.
-    #Keep track of whether we've found the first acceptable instance, because
-    #this allows us to stop the loop once we've gone out of range, saving some
-    #processing time.
-    first_instance_found = False
-    for i in range(prev_max_elt_index, len(page)):
+    #Only look at the text elements from prev_max_elt_index onwards.  (Other
+    #element types are not guaranteed to have the positioning attributes, so
+    #aren't in the page index.)  The indices are in ascending order, so we can
+    #find where those start with a binary search.
+    k_start = np.searchsorted(page_index["index"], prev_max_elt_index)
+
+    #The elements with top_bound < top < bottom_bound are a contiguous slice
+    #of the elements sorted by top, which we can also find with a binary
+    #search.  Then only those few candidates need checking against the left
+    #and right bounds (and prev_max_elt_index).
+    top_order = page_index["top_order"]
+    top_sorted = page_index["top_sorted"]
+    first = np.searchsorted(top_sorted, top_bound, side = "right")
+    last = np.searchsorted(top_sorted, bottom_bound, side = "left")
+    candidates = top_order[first:last]
+    candidate_left = page_index["left"][candidates]
+    in_range = ((candidate_left > left_bound) & (candidate_left < right_bound)
+            & (candidates >= k_start))
+    k_in_range = np.sort(candidates[in_range])
+
+    #The shot's elements are the first run of consecutive elements (in page
+    #order) that satisfy the boundary conditions.  Any element between two of
+    #the candidates failed the conditions, so the run ends at the first gap.
+    gaps = np.flatnonzero(np.diff(k_in_range) != 1)
+    if len(gaps) > 0:
+        k_in_range = k_in_range[:gaps[0] + 1]
+
+    elt_indices = page_index["index"][k_in_range]
+
+    #Alright, so at this point we want to know the maximum index (the indices
+    #are in ascending order, so it's the last one).
+    max_elt_index = int(max(elt_indices))
 
-        #If this isn't a text element, continue to the next one.
-        #(other element types are not guaranteed to have these positioning
-        #attributes)
-        if page[i].tag != "text":
-            continue
-
-        gl = int(page[i].attrib["left"]) > left_bound
-        lr = int(page[i].attrib["left"]) < right_bound
-        gt = int(page[i].attrib["top"]) > top_bound
-        lb = int(page[i].attrib["top"]) < bottom_bound
-
-        in_range = gl and lr and gt and lb
-
-        if in_range:
-            elt_dict[i] = page[i]
-            first_instance_found = True
-
-
-        if first_instance_found and not in_range:
-            break
-
-    #Alright, so at this point we want to know the maximum index.
-    max_elt_index = max(elt_dict.keys())
-
-    elt_list = elt_dict.values()
-    
     #Now, to get the remaining information, it looks like sometimes the turn
     #has a position slightly higher than the other items on the bottom row, so
     #sorting top to bottom and left to right doesn't work.
     #HOWEVER, the top element with the team and player name always has a colon
     #in it, a property shared by none of the fields.  So just sort left to
     #right, and extract the team and player name when we see the colon. 
-    sorted_elts = sorted(elt_list, key = lambda x: int(x.attrib["left"]))
+    #The sorts are stable argsorts on the cached positions, so elements with
+    #the same position stay in page order.
+    elt_left = page_index["left"][k_in_range]
+    elt_top = page_index["top"][k_in_range]
+    order = np.argsort(elt_left, kind = "stable")
 
     #Create our output dictionary and fill it.
     output_dict = {"team":None, "player_name":None, "type":None, "turn":None,
@@ -453,7 +624,7 @@ def get_shot_data(page, shot, image_list, prev_max_elt_index = 0):
     
     #If this is a no-statistics shot, we don't want to try and save things that
     #don't exist.  Just leave them as None in the output dictionary.
-    no_statistics_shot = len(sorted_elts) < 4
+    no_statistics_shot = len(order) < 4
     bottom_row_index = 0
     bottom_row_labels = ["type", "turn", "percent_score"]
     
@@ -463,9 +634,11 @@ def get_shot_data(page, shot, image_list, prev_max_elt_index = 0):
     #So , look at the sorted elements.  If there are too many (indicating
     #some extra information added there), remove the one with the largest top
     #value.
-    if len(sorted_elts) > 4:
-        sorted_top = sorted(elt_list, key = lambda x: int(x.attrib["top"]))
-        sorted_elts = sorted(sorted_top[:-1], key = lambda x: int(x.attrib["left"]))
+    if len(order) > 4:
+        order_top = np.argsort(elt_top, kind = "stable")[:-1]
+        order = order_top[np.argsort(elt_left[order_top], kind = "stable")]
+
+    sorted_elts = [page_index["elts"][k] for k in k_in_range[order]]
 
 
 
@@ -480,10 +653,10 @@ def get_shot_data(page, shot, image_list, prev_max_elt_index = 0):
 
         #First, check for the colon, and if it's there, fill in the team and
         #player name values.
-        if ":" in elt_text:
-            info_list = elt_text.split(":")
-            output_dict["team"] = info_list[0]
-            output_dict["player_name"] = info_list[1].strip(" ")
+        team_match = _TEAM_RE.match(elt_text)
+        if team_match is not None:
+            output_dict["team"] = team_match.group(1)
+            output_dict["player_name"] = team_match.group(2).strip(" ")
 
         elif not no_statistics_shot:
             
@@ -504,15 +677,15 @@ def get_shot_data(page, shot, image_list, prev_max_elt_index = 0):
     #First, strip any percent signs and convert to integers. 
     if output_dict["percent_score"] is not None:
         
-        output_dict["percent_score"] = output_dict["percent_score"].strip("\%")
+        percent_match = _PERCENT_RE.fullmatch(output_dict["percent_score"])
 
         #If the value is not convertable to an integer, assign is as None.
-        if not output_dict["percent_score"].isdigit():
+        if percent_match is None:
             output_dict["percent_score"] = None
 
         #Otherwise convert it to an integer.
         else:
-            output_dict["percent_score"] = int(output_dict["percent_score"])
+            output_dict["percent_score"] = int(percent_match.group(1))
 
 
         #Also, if a 4 scale was used, multiply by 25 to give a percent value.
@@ -533,7 +706,7 @@ def time_left_to_seconds(time_string):
 
     return minutes*60 + seconds
 
-def get_score_and_time(page, start_index = 0):
+def get_score_and_time(page, start_index = 0, page_index = None):
     """
     Give a page from the xml file, 
     extract the score at the end of this end,
@@ -545,6 +718,8 @@ def get_score_and_time(page, start_index = 0):
 
     Includes an optional start index (can feed it the max index for data in the
     last shot) to not loop through already checked entries unnecessarily.
+    Also optionally takes the output of index_page for the page, if it has
+    already been computed.
 
     Output format is {score: {TEAM1:VAL1 , TEAM2:VAL2 }, time_left:{TEAM1:VAL1,
     TEAM2: VAL2}}, or just None if the box with this information is not
@@ -570,31 +745,37 @@ def get_score_and_time(page, start_index = 0):
     [NAME1, NAME2, Score1, Score2, Time1, Time2].  Put into the correct output
     format accordingly.
     """
+    if page_index is None:
+        page_index = index_page(page)
+
+    #Only look at the text elements from start_index onwards.  The indices are
+    #in ascending order, so we can find where those start with a binary
+    #search.
+    k_start = np.searchsorted(page_index["index"], start_index)
+    left = page_index["left"][k_start:]
+    top = page_index["top"][k_start:]
+    text_array = page_index["text_array"][k_start:]
+    elts = page_index["elts"][k_start:]
+
+    #Find the "Total Score" and "Time left" labels, searching all the text at
+    #once.  (If there is more than one, the last one is used, and an element
+    #with both counts as "Total Score".)
+    is_score = np.char.find(text_array, "Total Score") >= 0
+    is_time = (np.char.find(text_array, "Time left") >= 0) & ~is_score
+    score_k = np.flatnonzero(is_score)
+    time_k = np.flatnonzero(is_time)
+
     score_top = 0
     score_left = 0
     time_top = 0
     time_left = 0
-    for i in range(start_index, len(page)):
-        
-        #If this isn't a text element, continue to the next one.
-        #(other element types are not guaranteed to have these positioning
-        #attributes)
-        if page[i].tag != "text":
-            continue
+    if len(score_k) > 0:
+        score_top = top[score_k[-1]]
+        score_left = left[score_k[-1]]
 
-        elt_text = page[i].text
-        
-        #Do a check for bold here just in case.)
-        if len(page[i]) == 1:
-            elt_text = page[i][0].text
-
-        if "Total Score" in elt_text:
-            score_top = int(page[i].attrib["top"])
-            score_left = int(page[i].attrib["left"])
-
-        elif "Time left" in elt_text:
-            time_top = int(page[i].attrib["top"])
-            time_left = int(page[i].attrib["left"])
+    if len(time_k) > 0:
+        time_top = top[time_k[-1]]
+        time_left = left[time_k[-1]]
 
 
     #If score_left is still zero, it means that it was not found in the
@@ -607,33 +788,16 @@ def get_score_and_time(page, start_index = 0):
     lowerbound = time_top + 30
     leftbound = score_left + 1
 
-    #Now, loop over elements again to pull out the country names, scores, and
-    #time remaining.
-    data_elts = []
-    for i in range(start_index, len(page)):
-        
-        #If this isn't a text element, continue to the next one.
-        #(other element types are not guaranteed to have these positioning
-        #attributes)
-        if page[i].tag != "text":
-            continue
-
-        elt_text = page[i].text
-        
-        #Do a check for bold here just in case.)
-        if len(page[i]) == 1:
-            elt_text = page[i][0].text
-
-        elt_left = int(page[i].attrib["left"])
-        elt_top = int(page[i].attrib["top"])
-
-        if (elt_left > leftbound) and (elt_top > upperbound) and (elt_top < lowerbound):
-            data_elts.append(page[i])
+    #Now, pull out the country names, scores, and time remaining, checking all
+    #the elements against the bounds at once.
+    in_box = np.flatnonzero((left > leftbound) & (top > upperbound)
+            & (top < lowerbound))
 
 
     #Now that we have all matching elements, sort them top to bottom and left
-    #to right.
-    sorted_elts = sorted(data_elts, key = lambda x: (int(x.attrib["top"]), int(x.attrib["left"])))
+    #to right.  (lexsort sorts by the last key first, and is stable.)
+    order = in_box[np.lexsort((left[in_box], top[in_box]))]
+    sorted_elts = [elts[k] for k in order]
     output_dict = {}
 
     #In some (only found one) cases, instead of putting the score, the game was just scored as
@@ -660,7 +824,7 @@ def get_score_and_time(page, start_index = 0):
 
 
 
-def get_name_and_sheet(page):
+def get_name_and_sheet(page, page_index = None):
     """
     A function to extract the game and sheet name from the document.  Just need
     to find the element with "Sheet" in the text, and then split on the
@@ -668,32 +832,27 @@ def get_name_and_sheet(page):
     There is some variability in the naming here (sometimes it will match the
     Session name, sometimes it will be a subdetail, e.g. "Group B".).  Returns
     a dict {name: GAMENAME, sheet:SHEET}.
+
+    Optionally takes the output of index_page for the page, if it has already
+    been computed.
     """
-    for i in range(len(page)):
-        
-        #If this isn't a text element, continue to the next one.
-        #(other element types are not guaranteed to have these positioning
-        #attributes)
-        if page[i].tag != "text":
-            continue
+    if page_index is None:
+        page_index = index_page(page)
 
-        elt_text = page[i].text
-        
-        #Do a check for bold here just in case.)
-        if len(page[i]) == 1:
-            elt_text = page[i][0].text
+    #Search all the text elements for "Sheet" at once.
+    sheet_k = np.flatnonzero(
+            np.char.find(page_index["text_array"], "Sheet") >= 0)
 
+    #Now if the string "Sheet" is in the text of any of them, extract the
+    #information from the first one and return.
+    if len(sheet_k) > 0:
 
-        #Now if the string "Sheet" is in the text, extract the information and
-        #return.
-        if "Sheet" in elt_text:
-            
-            text_array = elt_text.split("Sheet")
+        text_array = page_index["text"][sheet_k[0]].split("Sheet")
 
-            name = text_array[0].strip(" -")
-            sheet = text_array[-1].strip(" ")
+        name = text_array[0].strip(" -")
+        sheet = text_array[-1].strip(" ")
 
-            return {"name":name, "sheet":sheet}
+        return {"name":name, "sheet":sheet}
 
 
     #If we somehow get to the end of this without finding a name and sheet,
@@ -702,3 +861,20 @@ def get_name_and_sheet(page):
 
 
 
+
+
+def get_game_header(page, page_index = None):
+    """
+    A function to extract the game wide information that is in the header of
+    the first page of the document, i.e. the game name and sheet (see
+    get_name_and_sheet) and the start date and time (see get_date_and_time).
+    Returns a tuple (name_and_sheet, date_and_time) of their dicts.
+
+    Optionally takes the output of index_page for the page, if it has already
+    been computed, otherwise the page is only indexed once for both.
+    """
+    if page_index is None:
+        page_index = index_page(page)
+
+    return (get_name_and_sheet(page, page_index),
+            get_date_and_time(page, page_index))
@@ -11,456 +11,572 @@ the contents of the data directory.
 To facilitate adding new events (and for testing) a single-event mode is
 available by specifying a short name on the command line.
 
-Usage: python populate_db.py (short_name)
+Usage: python populate_db.py (short_name) [--jobs N]
     short_name is the optionally specified short name of an event, for single
 event mode.
+    --jobs N: The number of worker processes parsing the games (defaults to
+the number of CPU cores).
 
 """
+import argparse
 import database_functions as db
 from datetime import datetime
+import functools
 import pdf_parsing_functions as pf
-import glob
-import sys
 import os
-import xml.etree.ElementTree as ET
-
-
-#Get the current working directory, so we can go back up to it later.
-working_directory = os.getcwd()
-
-#Where we want to look for the data (nominally the data/ directory).
-starting_directory = "data/"
-
-#Change directory to the starting directory.
-os.chdir(starting_directory)
-
-#If one event short name was supplied on the command line, put that in our
-#short names list.  Otherwise, pull up the list of short names with glob.
-#NB: We will sort all glob.glob output, because this should give us an order
-#that makes some sense, which helps during testing.
-short_names = []
-
-if len(sys.argv) > 1:
-    short_names.append(sys.argv[1])
-
-else:
-    short_names = glob.glob("*")
-    short_names = sorted(short_names)
-
-#We'll build the database by going through the directory tree.  
-
-
-#Loop over the short names of each of the events to loop over the events.
-for event in short_names:
-
-    #These are the variables we must set for each event that go into the
-    #database.
-    #id: ID number of this event, the primary key.
-    #name_short: The abbreviation for this event's name.
-    #start_date: The start date of this event.
-    #end_date: The end date of this event.
-    #NB: The last 2 require input from the shot by shot summary files to
-    #   fill.
-    #start_date and end_date should be taken by finding the extrema of the
-    #game start dates for this event.
-    #So write out the event to the database as soon as pull the information from the
-    #PDF file, and update it with start and end date before moving on to the
-    #next event.
-    event_id = db.get_next_id("events")
-    event_name = event
-    event_start_date = ""
-    event_start_datetime = datetime.max  #Since use less than comparison of game
-                                   #dates to set this value.
-    event_end_date = ""
-    event_end_datetime = datetime.min  #Since use greater than comparison of game
-                                   #dates to set this value.
-
-    #Since we now have enough information to create this event entry, do so.
-    c = """
-        INSERT INTO events (
-            id, 
-            name)
-            VALUES (
-            "{}",
-            "{}");
-            """
-    db.run_command(c.format(event_id, event_name))
-
-
-    #Next directory level is type.  Change directory to this event's directory,
-    #then use glob to grab.
-    os.chdir(event)
-    game_types = glob.glob("*")
-    game_types = sorted(game_types)
-    for gt in game_types:
-
-        #Change to the game type directory in question.
-        os.chdir(gt)
-
-        #The game_type for saving to the database (in the games table) is
-        #either "Men" or "Women" (at least at this point), so convert gt to
-        #that.
-        game_type = ""
-        if gt == "Men\'s_Teams":
-            game_type = "Men"
-        elif gt == "Women\'s_Teams":
-            game_type = "Women"
-        else:
-            game_type = "Unknown"
-
-
-        #The rest of the information we need can be taken directly from the
-        #shot-by-shot summary files.  So descend down to that directory level
-        #and loop through those.
-        session_names = glob.glob("*")
-        session_names = sorted(session_names)
-        for session in session_names:
+from concurrent.futures import ProcessPoolExecutor
+
+
+#The columns of the rows we insert into each table (see db.bulk_insert).  Each
+#row is only written once we have everything for it, so there's nothing to
+#UPDATE afterwards.
+EVENT_COLUMNS = ("id", "name", "start_date", "end_date")
+
+GAME_COLUMNS = ("id", "event_id", "session", "name", "sheet", "type",
+        "start_date", "start_time", "team_red", "team_yellow",
+        "final_score_red", "final_score_yellow")
+
+END_COLUMNS = ("id", "game_id", "number", "direction", "color_hammer",
+        "score_red", "score_yellow", "time_left_red", "time_left_yellow")
+
+SHOT_COLUMNS = ("id", "end_id", "number", "color", "team", "player_name",
+        "type", "turn", "percent_score")
+
+STONE_POSITION_COLUMNS = ("id", "shot_id", "color", "x", "y")
+
+
+def sql_value(value):
+    """
+    Returns value as it should be passed to the database as an SQL parameter.
+    Missing (None) values are stored as the string "None" rather than NULL, as
+    they always have been, since the analysis notebooks look for them that way
+    (e.g. the shots with no type).
+    """
+    if value is None:
+        return "None"
+
+    return value
+
+
+def sql_params(*values):
+    """
+    Returns the tuple of SQL parameters for the given values (see sql_value).
+    """
+    return tuple(sql_value(v) for v in values)
+
+
+def sql_params_or_null(values, n):
+    """
+    Returns the tuple of SQL parameters for the given tuple of n values (see
+    sql_value), or n NULLs if values is None, i.e. we never found them.  (So
+    each of the columns is left empty, as opposed to the individual values
+    that are missing, which are stored as "None".)
+    """
+    if values is None:
+        return (None,) * n
+
+    return sql_params(*values)
+
+
+@functools.lru_cache(maxsize = None)
+def parse_game_date(date):
+    """
+    Returns the datetime for a game date as it appears on the shot by shot
+    summaries (e.g. "Sat 14 Feb 2015").  strptime is slow, and all the games
+    played on the same day have the same date string, so the results are
+    remembered.
+    """
+    return datetime.strptime(date, "%a %d %b %Y")
+
+
+def list_directories(path):
+    """
+    Returns a list of (name, path) pairs for the directories in the directory
+    at path, sorted by name.  os.scandir gives us the names and whether each
+    entry is a directory from the directory listing itself, without a stat call
+    per entry.
+    """
+    with os.scandir(path) as entries:
+        directories = [(entry.name, entry.path) for entry in entries
+                if entry.is_dir()]
+
+    return sorted(directories)
+
+
+def list_files(path, extension):
+    """
+    Returns a sorted list of the paths of the files in the directory at path
+    whose names end with extension (e.g. ".xml").  As with list_directories,
+    the directory listing itself says which entries are files.  Hidden files
+    (names starting with ".") are left out, as glob would.
+    """
+    with os.scandir(path) as entries:
+        files = [entry.path for entry in entries
+                if entry.name.endswith(extension)
+                and not entry.name.startswith(".") and entry.is_file()]
+
+    return sorted(files)
+
+
+def process_game(xml_path):
+    """
+    Extracts everything we need for the database from one game's shot by shot
+    summary (the xml file at xml_path, with the .png images for the stone
+    positions in the same directory).
+
+    This does all the parsing work for a game, and none of the database work,
+    so it can be run in a worker process (see main()).  The IDs are assigned
+    by main() when the game is written out, so that they are sequential in the
+    same order as the files.
+
+    Returns a dict with keys:
+        -"name_and_sheet": The output of pf.get_name_and_sheet for the first
+        page.
+        -"date_and_time": The output of pf.get_date_and_time for the first
+        page.
+        -"teams": (team_red, team_yellow), once known from the first two
+        shots, otherwise None.
+        -"final_score": (final_score_red, final_score_yellow) from the last
+        page, or None if it doesn't have the score box.
+        -"ends": A list with a dict for each end (page), with keys:
+            -"number": The end number.
+            -"hammer": (direction, color_hammer) from the first shot, or None
+            if there are no shots.
+            -"shots": A list of (number, color, team, player_name, type, turn,
+            percent_score) for each shot.
+            -"stone_positions": A list with a list of [color, x, y] for each
+            shot's stones in play.
+            -"score": (score_red, score_yellow, time_left_red,
+            time_left_yellow), or None if the page doesn't have the score box.
+    """
+    #The images are referred to relative to the directory of the xml file.
+    xml_dir = os.path.dirname(xml_path)
+
+    #The rest of these come from the PDF file.
+    team_to_color = {}
+    color_to_team = {}
+    team_red_name = None
+    team_yellow_name = None
+    game = {"name_and_sheet":{}, "date_and_time":{}, "teams":None,
+            "final_score":None, "ends":[]}
+
+
+    #Loop through the xml file.  Each individual page corresponds
+    #to an end.
+    #The pages are streamed from the file one at a time (see
+    #pf.iter_pages), so only the current page is held in memory.
+    #That means we don't know which page is the last one until
+    #we've finished, so keep the last page's score and time
+    #for the final score.
+    score_and_time = None
+    for ip, page in enumerate(pf.iter_pages(xml_path)):
+
+        #If it's the first page, extract the game wide information
+        #that can from there (all in the one call, see
+        #pf.get_game_header).
+        #Get the image list once on every page, as we need that for
+        #the shot-by-shot information, and the end information that
+        #needs to be extracted from the shot information.
+        #Also index the page's text elements once, for the
+        #functions that search them by position.
+        image_list = pf.get_image_list(page)
+        page_index = pf.index_page(page)
+        if ip == 0:
+            name_and_sheet, date_and_time = pf.get_game_header(page,
+                page_index)
+            game["name_and_sheet"] = name_and_sheet
+            game["date_and_time"] = date_and_time
+
+        #Each page corresponds to an end.
+        #The end number is just the page number (page index plus
+        #one)
+        end_number = ip + 1
+        end = {"number":end_number, "hammer":None, "shots":[],
+                "stone_positions":[], "score":None}
+        game["ends"].append(end)
+
+        #Now, loop through the list of images to extract shot by
+        #shot data.
+        #Store the previous maximum element index in the loop
+        #through the elements in the page for each shot, so that we
+        #don't have to waste time looping over elements we've
+        #already considered.
+        prev_max_elt_index = 0
+    
+        for si in range(len(image_list)):
+        
+            #Convert the shot index to shot number.
+            shot_number = si + 1
+
+
+            #Next, get the rock positions as a dataframe by
+            #passing the image path to the get_rock_positions
+            #function.
+            #This function takes the path to the image, which is in
+            #the "src" attribute of this element.
+            stone_df = pf.get_rock_positions(os.path.join(xml_dir,
+                image_list[si].attrib["src"]))
+
+            #Now, if it's the first shot, extract the direction of
+            #play, get the first shot color too. 
+            if si == 0:
+                direction_of_play = pf.get_direction_of_play(stone_df)
+                first_shot_color = pf.get_1st_shot_color(stone_df)
+
+                #The team with the hammer is the team color that
+                #does not.
+                if first_shot_color == "red":
+                    color_hammer = "yellow"
+                elif first_shot_color == "yellow":
+                    color_hammer = "red"
+                else:
+                    color_hammer = "error_color"
+
+                bool_dir_of_play = 0
+                if direction_of_play == "up":
+                    bool_dir_of_play = 1
+
+                #Keep the hammer color and the direction of play for the
+                #end table.
+                end["hammer"] = (bool_dir_of_play, color_hammer)
+            
+        
+
+        
+            #Now that we have the direction of play and the color
+            #of the first shot, standardize to one coordinate
+            #system and clean out all but the stones in play.
+            stone_positions = pf.clean_rock_positions(stone_df,
+                direction_of_play)
+
+            #Now, get the data for this shot.
+            shot_data = pf.get_shot_data(page, si + 1,
+                image_list, prev_max_elt_index, page_index)
+
+            #If this is the first shot of the first end, use this
+            #information to map team to shot color.
+            if (si == 0) and (ip == 0):
+                team_to_color[shot_data["team"]] = first_shot_color
             
-            #Change to the session directory, and pull up the list of xml files we
-            #will pull information from.
-            os.chdir(session)
-            xml_files = glob.glob("*.xml")
-            xml_files = sorted(xml_files)
-
-            #Add in a print statement so we know that something is
-            #happening.
-            print("Processing: " + event + " " + session)
-
-            #Loop over the xml files, and pull out the information we need.
-            for gf in xml_files:
-
-                #This is the list of variables we need to write to the
-                #database in the "games" table:
-                game_id = db.get_next_id("games")
-                
-                #We also write the current event_id values.
-                #We already extracted the game_type above.
-                
-                #The session is everything after the last "~" in the directory
-                #name
-                game_session = session[session.rindex("~") + 1:]
-                
-                #The rest of these come from the PDF file.
-                game_red = ""
-                game_yellow = ""
-                game_red_score = 0
-                game_yellow_score = 0
-                name_and_sheet = {}
-                date_and_time = {}
-                first_shot_color = ""
-                team_to_color = {}
-                color_to_team = {}
-
-
-                #Loop through the xml file.  Each individual page corresponds
-                #to an end.
-                tree = ET.parse(gf)
-                pages = tree.getroot()
-                for ip in range(len(pages)):
-
-                    #If it's the first page, extract the game wide information
-                    #that can from there.
-                    #Get the image list on every page, as we need that for the
-                    #shot-by-shot information, and the end information that
-                    #needs to be extracted from the shot information.
-                    image_list = pf.get_image_list(pages[ip])
-                    if ip == 0:
-                        name_and_sheet = pf.get_name_and_sheet(pages[ip])
-                        date_and_time = pf.get_date_and_time(pages[ip])
-
-                        #At this point we have all the information we need to
-                        #create a basic entry for this game in the database.
-                        #As with the event table, the data is not complete at
-                        #this point, but we have to create an entry so we can
-                        #create the ends, shots, and stone_positions tables.
-                        c = """
-                        INSERT INTO games (
-                        id,
-                        event_id,
-                        session,
-                        name,
-                        sheet,
-                        type,
-                        start_date,
-                        start_time)
-                        VALUES (
-                        "{}",
-                        "{}",
-                        "{}",
-                        "{}",
-                        "{}",
-                        "{}",
-                        "{}",
-                        "{}");
-                        """
-                        db.run_command(c.format(game_id, event_id, session,
-                            name_and_sheet["name"], name_and_sheet["sheet"],
-                            game_type, date_and_time["date"],
-                            date_and_time["time"]))
-
-                        #Also compare the date of this event to the stored
-                        #event start and end dates, so can establish the date
-                        #bounds of the event for writing to the event table. 
-                        curr_datetime = datetime.strptime(date_and_time["date"], "%a %d %b %Y")
+
+            #If it's the second shot of the first end, fill in the
+            #other team's name and shot color (i.e. color_hammer)
+            elif (si == 1) and (ip == 0):
+                team_to_color[shot_data["team"]] = color_hammer
+
+                #Now fill the color_to_team variable, for easy
+                #conversion the other way.
+                for elt in team_to_color.items():
+                    color_to_team[elt[1]] = elt[0]
+
+
+                #At this point we have the information we need to
+                #fill in this game's team names.  They don't change
+                #after this, so keep them for the score lookups on
+                #every page.
+                team_red_name = color_to_team["red"]
+                team_yellow_name = color_to_team["yellow"]
+                game["teams"] = (team_red_name, team_yellow_name)
+
+
+
+            #Extract the maximum element index for use in the next
+            #shot.
+            prev_max_elt_index = shot_data["max_elt_index"]
+
+            #At this point we should have all the shot data we need
+            #to assemble a full record. Do so now.
+            end["shots"].append((shot_number,
+                team_to_color[shot_data["team"]],
+                shot_data["team"],
+                shot_data["player_name"],
+                shot_data["type"],
+                shot_data["turn"],
+                shot_data["percent_score"]))
+
+            #We can also assemble the stone positions for this
+            #shot.  stone_positions already contains all the
+            #data for this shot, so we just need a row for each
+            #stone.  Take them all out of the DataFrame at once, as
+            #plain Python lists (which are also cheap to send back
+            #from the worker processes).
+            end["stone_positions"].append(
+                stone_positions[["color", "x", "y"]].to_numpy().tolist())
+        
+
+        #On every page we need to extract the score and the time
+        #left.
+        score_and_time = pf.get_score_and_time(page, 
+            prev_max_elt_index, page_index)
+
+
+        #Only deal with the score and time remaining if the box is
+        #present (the score_and_time variable is not None.
+        if(score_and_time is not None):
+   
+            #Fill score and time remaining for the end.
+            end["score"] = (
+                score_and_time["score"][team_red_name],
+                score_and_time["score"][team_yellow_name],
+                score_and_time["time_left"][team_red_name],
+                score_and_time["time_left"][team_yellow_name])
+
+
+    #Now that we've been through all the pages, fill the final
+    #score variable from the last page (if it had the score box).
+    if score_and_time is not None:
+        game_red_score = score_and_time["score"][team_red_name]
+        game_yellow_score = score_and_time["score"][team_yellow_name]
+        game["final_score"] = (game_red_score, game_yellow_score)
+
+    return game
+
+
+def main(starting_directory = "data", short_names = None, jobs = None):
+    """
+    Populates the database from the event directories in starting_directory
+    (nominally the data/ directory).  short_names is an optional list of the
+    short names of the events to load (e.g. the one given on the command line,
+    for single event mode), otherwise all the events found there are loaded.
+
+    The games are independent of each other, so they are parsed in parallel
+    by a pool of worker processes running process_game (jobs of them, or one
+    per CPU core if jobs is None).
+    This process does all the writing to the database, taking the games'
+    results in the same order as the files, so the IDs assigned are the same
+    as if they were processed one at a time.
+    """
+    #Everything below is done with absolute paths from the starting
+    #directory, rather than by changing directory, so that the worker
+    #processes see the same paths.
+    starting_directory = os.path.abspath(starting_directory)
+
+    #If we weren't given the events' short names, pull up the list of short
+    #names from the event directories.
+    #NB: We will sort all the directory listings, because this should give us an
+    #order that makes some sense, which helps during testing.
+    if short_names is None:
+        short_names = [name for name, path in
+                list_directories(starting_directory)]
+
+    #We'll build the database by going through the directory tree.  
+    #First, go through the tree and make a list of all the events, with the
+    #game type, session, and the (absolute) paths of the xml files for each of
+    #their sessions.
+    events = []
+    for event in short_names:
+        sessions = []
+        events.append((event, sessions))
+
+        #Next directory level is type.
+        event_path = os.path.join(starting_directory, event)
+        for gt, gt_path in list_directories(event_path):
+
+            #The game_type for saving to the database (in the games table) is
+            #either "Men" or "Women" (at least at this point), so convert gt to
+            #that.
+            game_type = ""
+            if gt == "Men\'s_Teams":
+                game_type = "Men"
+            elif gt == "Women\'s_Teams":
+                game_type = "Women"
+            else:
+                game_type = "Unknown"
+
+
+            #The rest of the information we need can be taken directly from
+            #the shot-by-shot summary files.  So descend down to that directory
+            #level and loop through those.
+            for session, session_path in list_directories(gt_path):
+            
+                #Pull up the list of xml files we will pull information from.
+                xml_files = list_files(session_path, ".xml")
+                sessions.append((game_type, session, xml_files))
+
+    #Hand all the games out to the worker processes.  executor.map gives the
+    #results back in the same order as the files, as they become available.
+    xml_paths = [xml_path for event, sessions in events
+            for game_type, session, session_xml_paths in sessions
+            for xml_path in session_xml_paths]
+
+    with ProcessPoolExecutor(max_workers = jobs) as executor:
+        games = executor.map(process_game, xml_paths)
+
+        #The whole ingest is done in one transaction, with durability switched
+        #off while it runs (see db.bulk_load()), so the database isn't synced to
+        #disk as each table's rows are inserted.  If anything goes wrong part
+        #way through, nothing is written, so the script can just be run again.
+        with db.bulk_load():
+
+            #Drop the indexes while the tables are filled, and build them again
+            #once everything has been written (see the end of this block).
+            #This is all in the one transaction, so if anything goes wrong the
+            #indexes are put back along with everything else.
+            index_sql = db.drop_user_indexes()
+
+            #Nothing else writes to the database while we're populating it, so
+            #look up the next ID for each table once here, and count up from
+            #there as we go, rather than asking the database every time we add
+            #a row.
+            next_event_id = db.get_next_id("events")
+            next_game_id = db.get_next_id("games")
+            next_end_id = db.get_next_id("ends")
+            next_shot_id = db.get_next_id("shots")
+            next_stone_id = db.get_next_id("stone_positions")
+
+            #Loop over the events.
+            for event, sessions in events:
+
+                #These are the variables we must set for each event that go
+                #into the database.
+                #id: ID number of this event, the primary key.
+                #name_short: The abbreviation for this event's name.
+                #start_date: The start date of this event.
+                #end_date: The end date of this event.
+                #NB: The last 2 require input from the shot by shot summary
+                #   files to fill.
+                #start_date and end_date should be taken by finding the extrema
+                #of the game start dates for this event.
+                #So first take all of this event's games' results, to find the
+                #start and end dates, and then write out the complete event
+                #entry, followed by its games.
+                event_id = next_event_id
+                next_event_id += 1
+                event_name = event
+                event_start_date = ""
+                #Since use less than comparison of game dates to set this
+                #value.
+                event_start_datetime = datetime.max
+                event_end_date = ""
+                #Since use greater than comparison of game dates to set this
+                #value.
+                event_end_datetime = datetime.min
+
+                #The (game_type, session, game) for each of the event's games.
+                event_games = []
+                for game_type, session, session_xml_paths in sessions:
+
+                    #Add in a print statement so we know that something is
+                    #happening.
+                    print("Processing: " + event + " " + session)
+
+                    #Loop over the games' results.
+                    for xml_path in session_xml_paths:
+                        game = next(games)
+
+                        #A file with no pages has no game in it.
+                        if len(game["ends"]) == 0:
+                            continue
+
+                        event_games.append((game_type, session, game))
+
+                        #Compare the date of this game to the stored event
+                        #start and end dates, so can establish the date bounds
+                        #of the event for writing to the event table.
+                        game_date = game["date_and_time"]["date"]
+                        curr_datetime = parse_game_date(game_date)
 
                         if(curr_datetime < event_start_datetime):
                             event_start_datetime = curr_datetime
-                            event_start_date = date_and_time["date"]
+                            event_start_date = game_date
 
                         if(curr_datetime > event_end_datetime):
                             event_end_datetime = curr_datetime
-                            event_end_date = date_and_time["date"]
-
-                    #Each page corresponds to an end.  So get out the
-                    #information we need to start the end entry.
-                    end_id = db.get_next_id("ends")
-                    
-                    #The end number is just the page number (page index plus
-                    #one)
-                    end_number = ip + 1
-
-                    #The rest of the information we need to look at the shots
-                    #at, so create the ends table entries now an update them
-                    #later with shot information.
-                    c = """
-                    INSERT INTO ends(
-                    id,
-                    game_id,
-                    number)
-                    VALUES(
-                    "{}",
-                    "{}",
-                    "{}");
-                    """
-                    db.run_command(c.format(end_id, game_id, end_number))
-
-                    #Now, loop through the list of images to extract shot by
-                    #shot data.
-                    #Store the previous maximum element index in the loop
-                    #through the elements in the page for each shot, so that we
-                    #don't have to waste time looping over elements we've
-                    #already considered.
-                    prev_max_elt_index = 0
-                    
-                    #Use the first shot color to get the color with the hammer
-                    #(the other color), and the direction of play.
-                    color_hammer = ""
-                    direction_of_play = ""
-                    for si in range(len(image_list)):
-                        
-                        #First, get a new shot_id for this shot.
-                        shot_id = db.get_next_id("shots")
-
-                        #Convert the shot index to shot number.
-                        shot_number = si + 1
-
-
-                        #Next, get the rock positions as a dataframe by
-                        #passing the image path to the get_rock_positions
-                        #function.
-                        #This function takes the path to the image, which is in
-                        #the "src" attribute of this element.
-                        stone_df = pf.get_rock_positions(image_list[si].attrib["src"])
-
-                        #Now, if it's the first shot, extract the direction of
-                        #play, get the first shot color too. 
-                        if si == 0:
-                            direction_of_play = pf.get_direction_of_play(stone_df)
-                            first_shot_color = pf.get_1st_shot_color(stone_df)
-
-                            #The team with the hammer is the team color that
-                            #does not.
-                            if first_shot_color == "red":
-                                color_hammer = "yellow"
-                            elif first_shot_color == "yellow":
-                                color_hammer = "red"
-                            else:
-                                color_hammer = "error_color"
-
-                            bool_dir_of_play = 0
-                            if direction_of_play == "up":
-                                bool_dir_of_play = 1
-
-                            #Update the end table with the hammer color and the
-                            #direction of play.
-                            c = """
-                            UPDATE ends
-                            SET direction = "{}", color_hammer = "{}"
-                            WHERE id = "{}";
-                            """
-                            db.run_command(c.format(bool_dir_of_play, color_hammer, end_id))
-                            
-                        
-
-                        
-                        #Now that we have the direction of play and the color
-                        #of the first shot, standardize to one coordinate
-                        #system and clean out all but the stones in play.
-                        stone_positions = pf.clean_rock_positions(stone_df,
-                            direction_of_play)
-
-                        #Now, get the data for this shot.
-                        shot_data = pf.get_shot_data(pages[ip], si + 1,
-                            image_list, prev_max_elt_index)
-
-                        #If this is the first shot of the first end, use this
-                        #information to map team to shot color.
-                        if (si == 0) and (ip == 0):
-                            team_to_color[shot_data["team"]] = first_shot_color
-                            
-
-                        #If it's the second shot of the first end, fill in the
-                        #other team's name and shot color (i.e. color_hammer)
-                        elif (si == 1) and (ip == 0):
-                            team_to_color[shot_data["team"]] = color_hammer
-
-                            #Now fill the color_to_team variable, for easy
-                            #conversion the other way.
-                            for elt in team_to_color.items():
-                                color_to_team[elt[1]] = elt[0]
-
-
-                            #At this point we have the information we need to
-                            #update this game's database entry with the team
-                            #names.
-                            c = """
-                            UPDATE games
-                            SET team_red = "{}", team_yellow = "{}"
-                            WHERE id = "{}";
-                            """
-                            db.run_command(c.format(color_to_team["red"],
-                                color_to_team["yellow"], game_id))
-
-
-
-                        #Extract the maximum element index for use in the next
-                        #shot.
-                        prev_max_elt_index = shot_data["max_elt_index"]
-
-                        #At this point we should have all the shot data we need
-                        #to assemble a full record. Do so now.
-                        c = """
-                        INSERT INTO shots (
-                        id,
-                        end_id,
-                        number,
-                        color,
-                        team,
-                        player_name,
-                        type,
-                        turn,
-                        percent_score)
-                        VALUES (
-                        "{}",
-                        "{}",
-                        "{}",
-                        "{}",
-                        "{}",
-                        "{}",
-                        "{}",
-                        "{}",
-                        "{}");
-                        """
-                        db.run_command(c.format(shot_id,
-                            end_id, 
-                            shot_number,
-                            team_to_color[shot_data["team"]],
-                            shot_data["team"],
-                            shot_data["player_name"],
-                            shot_data["type"],
-                            shot_data["turn"],
-                            shot_data["percent_score"]))
-
-                        #Now that there is an entry for the shot data, we can
-                        #write out the stone positions for this shot.
-                        #stone_positions already contains all the data for this
-                        #shot, so we just need to iterate over it and write
-                        #each row to the database.
-                        for sp_index, sp_row in stone_positions.iterrows():
-                            stone_id = db.get_next_id("stone_positions")
-
-                            c = """
-                            INSERT INTO stone_positions(
-                            id,
-                            shot_id,
-                            color,
-                            x,
-                            y)
-                            VALUES (
-                            "{}",
-                            "{}",
-                            "{}",
-                            "{}",
-                            "{}");
-                            """
-                            db.run_command(c.format(stone_id,
-                                shot_id,
-                                sp_row["color"],
-                                sp_row["x"],
-                                sp_row["y"]))
-                        
-
-                    #On every page we need to extract the score and the time
-                    #left.
-                    score_and_time = pf.get_score_and_time(pages[ip], 
-                        prev_max_elt_index)
-
-
-                    #Only deal with the score and time remaining if the box is
-                    #present (the score_and_time variable is not None.
-                    if(score_and_time is not None):
-                   
-                        #Fill score and time remaining for the end.
-                        c = """
-                        UPDATE ends
-                        SET score_red = "{}", score_yellow = "{}",
-                        time_left_red = "{}", time_left_yellow = "{}"
-                        WHERE id = "{}"
-                        """
-                        db.run_command(c.format(score_and_time["score"][color_to_team["red"]],
-                            score_and_time["score"][color_to_team["yellow"]],
-                            score_and_time["time_left"][color_to_team["red"]],
-                            score_and_time["time_left"][color_to_team["yellow"]],
-                            end_id))
-
-
-                        #If it's the last page, fill the final score variable
-                        #and write it to the database.
-                        if ip == len(pages) - 1:
-                            game_red_score = score_and_time["score"][color_to_team["red"]]
-                            game_yellow_score = score_and_time["score"][color_to_team["yellow"]]
-                            c = """
-                            UPDATE games
-                            SET final_score_red = "{}", final_score_yellow = "{}"
-                            WHERE id = "{}";
-                            """
-                            db.run_command(c.format(game_red_score,
-                                game_yellow_score, game_id))
-
-
-
-               
-
-
-            #Now that we're done with the session, go up one level so we can
-            #continue to the next session.
-            os.chdir("..")
-
-        #Now that we've gone through all the session, go up one level to the
-        #game types directory.
-        os.chdir("..")
-
-
-    #Now that we've gone through all the game types, go up one level so we can
-    #pull the next event.
-    os.chdir("..")
-
-    #Update the event entry with the start and end dates before proceeding to
-    #the next event.
-    c = """
-    UPDATE events
-    SET start_date = "{}", end_date = "{}"
-    WHERE id = "{}";
-    """
-    db.run_command(c.format(event_start_date, event_end_date, event_id))
-
+                            event_end_date = game_date
+
+                #Since we now have all the information for this event entry,
+                #create it.
+                db.bulk_insert("events", EVENT_COLUMNS, [sql_params(event_id,
+                    event_name, event_start_date, event_end_date)])
+
+                #Now write out the information we need for each game.
+                for game_type, session, game in event_games:
+
+                    #This is the list of variables we need to write to the
+                    #database in the "games" table:
+                    game_id = next_game_id
+                    next_game_id += 1
+
+                    #We also write the current event_id values.
+                    #We already extracted the game_type above.
+
+                    #We have everything for this game's entry now, including
+                    #the team names and the final score (if we found them).
+                    name_and_sheet = game["name_and_sheet"]
+                    date_and_time = game["date_and_time"]
+                    game_row = (sql_params(game_id, event_id, session,
+                        name_and_sheet["name"], name_and_sheet["sheet"],
+                        game_type, date_and_time["date"], date_and_time["time"])
+                        + sql_params_or_null(game["teams"], 2)
+                        + sql_params_or_null(game["final_score"], 2))
+
+                    #Build up all the rows for this game's ends, shots and
+                    #stone positions in memory first, and then write them all
+                    #out together once we have the whole game.
+                    end_rows = []
+                    shot_rows = []
+                    stone_rows = []
+                    for end in game["ends"]:
+
+                        #Each page corresponds to an end.  So create the end
+                        #entry, with the hammer color and the direction of
+                        #play, and the score and time remaining (if the box was
+                        #present).
+                        end_id = next_end_id
+                        next_end_id += 1
+                        end_rows.append(sql_params(end_id, game_id,
+                            end["number"])
+                            + sql_params_or_null(end["hammer"], 2)
+                            + sql_params_or_null(end["score"], 4))
+
+                        #Now all the shots for this end, and their stone
+                        #positions, with the next blocks of IDs.
+                        for shot, stones in zip(end["shots"],
+                                end["stone_positions"]):
+                            shot_id = next_shot_id
+                            next_shot_id += 1
+                            shot_rows.append(sql_params(shot_id, end_id, *shot))
+
+                            n_stones = len(stones)
+                            stone_rows.extend((stone_id, shot_id, *stone)
+                                for stone_id, stone in zip(range(next_stone_id,
+                                next_stone_id + n_stones), stones))
+                            next_stone_id += n_stones
+
+                    #Now write out the game, then its ends, shots and stone
+                    #positions (each referring to the one before), one bulk
+                    #insert for each table.
+                    db.bulk_insert("games", GAME_COLUMNS, [game_row])
+                    db.bulk_insert("ends", END_COLUMNS, end_rows)
+                    db.bulk_insert("shots", SHOT_COLUMNS, shot_rows)
+                    db.bulk_insert("stone_positions", STONE_POSITION_COLUMNS,
+                        stone_rows)
+
+            #Now all the data is in, build the indexes again.
+            db.restore_indexes(index_sql)
+
+            #And fill the packed copy of the stone positions (one row per
+            #shot) from the stone_positions table.  This is done after the
+            #indexes are back, as it looks up each shot's stones by shot_id.
+            db.build_packed_stone_positions()
+
+
+#Everything is run from main() under this guard, so that the worker processes
+#can import this script without re-running the ingest (which is what happens
+#when they are started with "spawn", e.g. on Windows and macOS).
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Populate the database "
+            "from the converted shot by shot summaries in the data directory.")
+    parser.add_argument("event", nargs = "?", default = None,
+            help = "The short name of a single event to load.")
+    parser.add_argument("--jobs", type = int, default = os.cpu_count(),
+            help = "The number of games to parse at once.")
+    args = parser.parse_args()
+
+    #If one event short name was supplied on the command line, put that in our
+    #short names list.
+    short_names = None
+    if args.event is not None:
+        short_names = [args.event]
+
+    main("data", short_names, args.jobs)